@@ -0,0 +1,288 @@
+# Benchmark for the link posting hot path: check_message -> archive_video -> archive channel post.
+# Drives com_major with synthetic messages against a temporary database prefilled with archives of
+# the given sizes, YouTube and Discord are replaced with in-process fakes. Prints JSON with per-message
+# latency percentiles and throughput for every archive size.
+# Run from anywhere: python benchmarks/hot_path.py [--sizes 1000,100000,1000000] [--output result.json]
+from datetime import datetime, timedelta
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import string
+import sys
+import tempfile
+import time
+
+import yaml
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+GUILD = 501
+WATCHED_CHANNEL = 1001
+ARCHIVE_CHANNEL = 2001
+USERS = list(range(3001, 3051))
+LINK_PREFIX = 'https://www.youtube.com/watch?v='
+
+
+class FakeYoutube:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+
+    async def fetch_videos_info(self, video_ids):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return {video_id: {'title': f'Artist {video_id} - Song', 'categoryId': '10'} for video_id in video_ids}
+
+    def close(self):
+        pass
+
+
+class FakeGuild:
+    def __init__(self, guild_id, members, emojis):
+        self.id = guild_id
+        self.members = members
+        self.emojis = emojis
+
+
+class FakeEmoji:
+    def __init__(self, name, guild_id):
+        self.name = name
+        self.guild_id = guild_id
+
+
+class FakeChannel:
+    def __init__(self, channel_id):
+        self.id = channel_id
+        self.guild = FakeGuild(GUILD, [], [])
+        self.sent = 0
+
+    async def send(self, content):
+        self.sent += 1
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.display_name = f'user{user_id}'
+        self.mention = f'<@{user_id}>'
+
+
+class FakeMessage:
+    def __init__(self, channel, author, content):
+        self.channel = channel
+        self.author = author
+        self.content = content
+        self.guild = channel.guild
+        self.created_at = datetime.utcnow()
+
+    async def add_reaction(self, emoji):
+        pass
+
+
+def make_config(work_dir, log_level, write_delay):
+    return {
+        'debug': {'debug level': log_level, 'sentry dsn': '', 'sentry appname': 'benchmark', 'sentry environment': ''},
+        'bot': {
+            'admin users': [], 'bot token': '', 'watched channels': [WATCHED_CHANNEL],
+            'target video channel': ARCHIVE_CHANNEL, 'command prefix': '$', 'ok reply': 'Done',
+            'archive posting warning': '', 'utc time offset': 3, 'allow copies in archive': True,
+            'duplicacte emoji': 'duplicate', 'archive depth': 10000, 'max pips in report': 50,
+        },
+        'youtube': {'client secrets file': '', 'credentials file': '', 'eligible categories': ['10']},
+        'lastfm': {'token': ''},
+        'database': {
+            'path': os.path.join(work_dir, 'comrade.db'), 'init_script': os.path.join(REPO_DIR, 'init.sql'),
+            'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'birthday_report_time': 15, 'check_frequency': 3600,
+            'write_delay': write_delay,
+        },
+    }
+
+
+def video_key(number):
+    return f'{number:011d}'
+
+
+def random_key():
+    return ''.join(random.choices(string.ascii_letters + string.digits + '-_', k=11))
+
+
+# Fill Videos/Posted directly, the rollup triggers keep the derived tables consistent
+def prefill(db_path, size):
+    connection = sqlite3.connect(db_path)
+    start = datetime(2015, 1, 1)
+    with connection:
+        connection.executemany(
+            'INSERT INTO Videos(id, link, video_title) VALUES (?, ?, ?);',
+            ((number + 1, LINK_PREFIX + video_key(number), f'Artist {number} - Song') for number in range(size))
+        )
+        connection.executemany(
+            'INSERT INTO Posted(video_id, archive_channel, source_channel, user_id, date_posted) VALUES (?, ?, ?, ?, ?);',
+            ((number + 1, ARCHIVE_CHANNEL, WATCHED_CHANNEL, USERS[number % len(USERS)],
+              (start + timedelta(minutes=5 * number)).strftime('%Y-%m-%d %H:%M:%S')) for number in range(size))
+        )
+    connection.close()
+
+
+# Mix of fresh links, reposts of archived links and messages without links
+def make_messages(count, archive_size, duplicate_ratio, plain_ratio):
+    channel = FakeChannel(WATCHED_CHANNEL)
+    authors = [FakeUser(user_id) for user_id in USERS]
+    messages = []
+    for _ in range(count):
+        roll = random.random()
+        if roll < plain_ratio:
+            content = 'just chatting, nothing to archive here'
+        elif roll < plain_ratio + duplicate_ratio and archive_size:
+            content = f'again {LINK_PREFIX}{video_key(random.randrange(archive_size))}'
+        else:
+            content = f'check this out {LINK_PREFIX}{random_key()}'
+        messages.append(FakeMessage(channel, random.choice(authors), content))
+    return messages
+
+
+def percentiles(latencies):
+    cuts = statistics.quantiles(latencies, n=100, method='inclusive')
+    return {
+        'p50': round(cuts[49] * 1000, 4),
+        'p95': round(cuts[94] * 1000, 4),
+        'p99': round(cuts[98] * 1000, 4),
+        'max': round(max(latencies) * 1000, 4),
+    }
+
+
+async def run_size(bot, work_dir, size, args):
+    from comrade_db import AsyncDB
+    from metrics import METRICS
+    from youtube import VideoMetaCache
+
+    db_path = os.path.join(work_dir, f'archive_{size}.db')
+    db = AsyncDB(db_path, os.path.join(REPO_DIR, 'init.sql'), bot.db_pragmas, bot.db_cached_statements,
+                 bot.db_write_batch, bot.db_write_delay)
+    started = time.perf_counter()
+    prefill(db_path, size)
+    prefill_seconds = time.perf_counter() - started
+    await db.connect()
+    await db.set_guild(GUILD, ARCHIVE_CHANNEL, WATCHED_CHANNEL, 'duplicate', 3)
+    await db.watch_channel(GUILD, WATCHED_CHANNEL)
+
+    youtube = FakeYoutube(args.youtube_latency)
+    bot.db = db
+    bot.youtube_cache = VideoMetaCache(youtube, db, bot.youtube_cache_size)
+
+    # Warm up the statement cache and the page cache
+    for message in make_messages(args.warmup, size, args.duplicate_ratio, args.plain_ratio):
+        await bot.check_message(message, allow_copies=bot.allow_copies)
+
+    # Sequential: latency of a single message
+    METRICS.clear()
+    latencies = []
+    messages = make_messages(args.messages, size, args.duplicate_ratio, args.plain_ratio)
+    started = time.perf_counter()
+    for message in messages:
+        message_started = time.perf_counter()
+        await bot.check_message(message, allow_copies=bot.allow_copies)
+        latencies.append(time.perf_counter() - message_started)
+    sequential_seconds = time.perf_counter() - started
+
+    # Concurrent: a burst of messages handled at once, as discord.py dispatches them
+    messages = make_messages(args.messages, size, args.duplicate_ratio, args.plain_ratio)
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def handle(message):
+        async with semaphore:
+            await bot.check_message(message, allow_copies=bot.allow_copies)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(handle(message) for message in messages))
+    concurrent_seconds = time.perf_counter() - started
+
+    await db.close()
+    return {
+        'archive_size': size,
+        'messages': args.messages,
+        'prefill_seconds': round(prefill_seconds, 3),
+        'latency_ms': percentiles(latencies),
+        'throughput_sequential': round(args.messages / sequential_seconds, 1),
+        'throughput_concurrent': round(args.messages / concurrent_seconds, 1),
+        'youtube_calls': youtube.calls,
+        'archive_channel_messages': bot.client.get_channel(ARCHIVE_CHANNEL).sent,
+        'slowest_operations': [
+            {'operation': f'{kind}.{name}', 'calls': histogram.count, 'mean_ms': round(histogram.mean * 1000, 4),
+             'p95_ms': round(histogram.quantile(0.95) * 1000, 4)}
+            for kind, name, histogram in METRICS.top(10)
+        ],
+    }
+
+
+async def run(bot, work_dir, args):
+    bot.guild_cache.load([FakeGuild(GUILD, [FakeUser(user_id) for user_id in USERS], [FakeEmoji('duplicate', GUILD)])])
+    archive_channel = FakeChannel(ARCHIVE_CHANNEL)
+    bot.client.get_channel = lambda channel_id: archive_channel if channel_id == ARCHIVE_CHANNEL else None
+    results = []
+    for size in args.sizes:
+        archive_channel.sent = 0
+        print(f'Archive size {size}...', file=sys.stderr)
+        results.append(await run_size(bot, work_dir, size, args))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='1000,100000,1000000', help='comma separated archive sizes')
+    parser.add_argument('--messages', type=int, default=2000, help='messages per run')
+    parser.add_argument('--warmup', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=50, help='messages in flight for the throughput run')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.1, help='share of reposted archived links')
+    parser.add_argument('--plain-ratio', type=float, default=0.3, help='share of messages without links')
+    parser.add_argument('--youtube-latency', type=float, default=0.0, help='simulated API latency, seconds')
+    parser.add_argument('--write-delay', type=float, default=0, help='database write_delay, group commit window')
+    parser.add_argument('--asyncio-debug', action='store_true', help='keep asyncio debug mode the bot enables')
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='write JSON here instead of stdout')
+    args = parser.parse_args()
+    args.sizes = [int(size) for size in args.sizes.split(',')]
+    random.seed(args.seed)
+
+    output = os.path.abspath(args.output) if args.output else None
+    with tempfile.TemporaryDirectory() as work_dir:
+        # com_major reads config.yaml and opens its log from the working directory on import
+        with open(os.path.join(work_dir, 'config.yaml'), 'w', encoding='utf-8') as configfile:
+            yaml.safe_dump(make_config(work_dir, args.log_level, args.write_delay), configfile)
+        os.chdir(work_dir)
+        import com_major as bot
+
+        loop = asyncio.get_event_loop()
+        loop.set_debug(args.asyncio_debug)
+        try:
+            results = loop.run_until_complete(run(bot, work_dir, args))
+        finally:
+            loop.run_until_complete(bot.lastfm.close())
+            loop.run_until_complete(bot.db.close())
+        os.chdir(REPO_DIR)
+
+    report = {
+        'benchmark': 'hot_path',
+        'timestamp': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'settings': {key: value for key, value in vars(args).items() if key != 'output'},
+        'results': results,
+    }
+    if output:
+        with open(output, 'w', encoding='utf-8') as outfile:
+            json.dump(report, outfile, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+# Micro-benchmark for title normalization. Compares videos_meta.normalize_titles with the
+# original per-title implementation on a corpus of real-world titles and checks they agree.
+# Run from the repo root: python benchmarks/titles.py [--repeat N]
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from videos_meta import normalize_titles
+
+
+CORPUS = [
+    'Boards of Canada - Roygbiv',
+    'Aphex Twin - Windowlicker (Official Video)',
+    'Daft Punk - Around The World [Official Music Video]',
+    'Portishead – Glory Box',
+    'Massive Attack — Teardrop (Official Video) [HD]',
+    'Radiohead | Everything In Its Right Place',
+    'Burial / Archangel',
+    'The Prodigy - Firestarter (Official Video) | HD Remastered',
+    'Кино - Группа крови',
+    'Гражданская Оборона - Всё идёт по плану (1988)',
+    'Би-2 - Полковнику никто не пишет',
+    'Ryuichi Sakamoto - Merry Christmas Mr. Lawrence 戦場のメリークリスマス',
+    '坂本龍一 - 戦場のメリークリスマス (Live)',
+    'YOASOBI「夜に駆ける」 Official Music Video',
+    'Joy Division - Love Will Tear Us Apart [Official Video] (Remastered 2019)',
+    'Molchat Doma - Судно (Борис Рыжий)',
+    'Nirvana - Smells Like Teen Spirit (Official Music Video)',
+    'Live at KEXP',
+    'Björk - Jóga (Official Music Video)',
+    'Sigur Rós - Hoppípolla',
+    'Mr. Oizo - Flat Beat [Official Video]',
+    'Kraftwerk – The Model (Remastered) 🎵🎶',
+    'Lofi hip hop radio 📚 - beats to relax/study to',
+    '周杰倫 Jay Chou【告白氣球 Love Confession】Official MV',
+    'BTS (방탄소년단) \'Dynamite\' Official MV',
+    'Tame Impala - The Less I Know The Better (Official Video)',
+    'DJ Shadow – Midnight In A Perfect World',
+    'Моя любимая песня',
+    'Amon Tobin | Easy Muffin',
+    'Four Tet - Baby (Official Video) [Text Records]',
+    '【作業用BGM】ジブリ ピアノメドレー - 久石譲 スタジオジブリ 名曲集 (睡眠用・勉強用) 夏の日の思い出 千と千尋の神隠し 天空の城ラピュタ',
+]
+
+
+# Implementation before the batch API, kept here as the reference for correctness and speed
+def reference_normalize(video_title):
+    delimiters = ('-', '–', '—', '|', '/')
+    parts = None
+    for delimiter in delimiters:
+        parts = video_title.split(delimiter, maxsplit=1)
+        if len(parts) > 1:
+            break
+    else:
+        return None
+    clean = []
+    for part in parts:
+        for character in part:
+            if character > '丠':
+                part = part.replace(character, '')
+        part = re.sub('[\(\[].*?[\)\]]', '', part)
+        clean.append(part.strip())
+    return tuple(clean)
+
+
+def measure(func, titles):
+    started = time.perf_counter()
+    result = func(titles)
+    return time.perf_counter() - started, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=3000, help='corpus copies, 3000 is ~100k titles')
+    args = parser.parse_args()
+
+    titles = CORPUS * args.repeat
+    reference_time, reference = measure(lambda items: [reference_normalize(title) for title in items], titles)
+    batch_time, batch = measure(lambda items: list(normalize_titles(items)), titles)
+
+    if reference != batch:
+        for title, expected, got in zip(titles, reference, batch):
+            if expected != got:
+                print(f'Mismatch for {title!r}: expected {expected!r}, got {got!r}')
+                break
+        sys.exit(1)
+
+    print(f'{len(titles)} titles')
+    print(f'reference: {reference_time:.3f}s ({reference_time / len(titles) * 1e6:.2f}us per title)')
+    print(f'batch:     {batch_time:.3f}s ({batch_time / len(titles) * 1e6:.2f}us per title)')
+    print(f'speedup:   {reference_time / batch_time:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
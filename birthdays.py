@@ -0,0 +1,123 @@
+from datetime import date, datetime, timedelta
+import asyncio
+import calendar
+import heapq
+import logging
+
+
+# Birthday as (day, month) from 'dd.mm' or 'dd.mm.yyyy', None if it's not a valid date
+def parse_birthday(date_raw):
+    try:
+        parts = [int(part) for part in date_raw.split('.')]
+        if len(parts) not in (2, 3):
+            return None
+        day, month = parts[0], parts[1]
+        # 2000 is a leap year, so 29.02 passes
+        date(2000, month, day)
+        return day, month
+    except (AttributeError, ValueError):
+        return None
+
+
+# Congratulations as a heap of due times (naive UTC). The task sleeps until the earliest one and is woken up
+# when a birthday changes. Dates and the report hour are local: UTC + utc_offset hours
+class BirthdayScheduler:
+    # Failed congratulations are retried after this delay, seconds
+    retry_delay = 300
+    # Longest single sleep, the heap is rechecked after it even without a wakeup (clock adjustments)
+    max_sleep = 24 * 3600
+
+    def __init__(self, report_hour, utc_offset):
+        self.logger = logging.getLogger("comrade")
+        self.report_hour = report_hour
+        self.utc_offset = timedelta(hours=utc_offset)
+        self.heap = []
+        # member id -> (birthday, last reported year, due, due year)
+        self.entries = {}
+        self.wakeup = asyncio.Event()
+
+    # Rows are (member_id, birthday, last_reported) as in Members
+    def load(self, rows):
+        self.heap = []
+        self.entries = {}
+        for member_id, date_raw, last_reported in rows:
+            birthday = parse_birthday(date_raw)
+            if birthday is None:
+                self.logger.error(f'Invalid birthday {date_raw} for {member_id}, skipped')
+                continue
+            self._schedule(member_id, birthday, last_reported)
+        self.wakeup.set()
+
+    # New or changed birthday. The last reported year is kept, so a member is congratulated once a year
+    def set(self, member_id, date_raw, now=None):
+        birthday = parse_birthday(date_raw)
+        entry = self.entries.pop(member_id, None)
+        if birthday is None:
+            return None
+        due = self._schedule(member_id, birthday, entry[1] if entry else None, now)
+        self.wakeup.set()
+        return due
+
+    # Local report time of the birthday in the year, 29.02 falls on 28.02 in common years
+    def _local_due(self, birthday, year):
+        day, month = birthday
+        if month == 2 and day == 29 and not calendar.isleap(year):
+            day = 28
+        return datetime(year, month, day) + timedelta(hours=self.report_hour)
+
+    # Next congratulation: today's is still due if it hasn't been sent yet, even after the report hour
+    def _schedule(self, member_id, birthday, last_reported, now=None):
+        local_now = (now or datetime.utcnow()) + self.utc_offset
+        year = local_now.year
+        local_due = self._local_due(birthday, year)
+        if last_reported == year or local_due.date() < local_now.date():
+            year += 1
+            local_due = self._local_due(birthday, year)
+        due = local_due - self.utc_offset
+        self.entries[member_id] = (birthday, last_reported, due, year)
+        heapq.heappush(self.heap, (due, member_id, year))
+        return due
+
+    def _push_retry(self, member_id, now):
+        birthday, last_reported, due, year = self.entries[member_id]
+        due = now + timedelta(seconds=self.retry_delay)
+        self.entries[member_id] = (birthday, last_reported, due, year)
+        heapq.heappush(self.heap, (due, member_id, year))
+
+    # Drop heap items superseded by set
+    def _peek(self):
+        while self.heap:
+            due, member_id, year = self.heap[0]
+            entry = self.entries.get(member_id)
+            if entry is not None and entry[2] == due and entry[3] == year:
+                return self.heap[0]
+            heapq.heappop(self.heap)
+
+    # congratulate(member_id, year) is awaited for every due birthday
+    async def run(self, congratulate):
+        while True:
+            self.wakeup.clear()
+            now = datetime.utcnow()
+            item = self._peek()
+            if item is not None and item[0] <= now:
+                due, member_id, year = heapq.heappop(self.heap)
+                try:
+                    await congratulate(member_id, year)
+                except Exception as e:
+                    self.logger.error(f'Failed to congratulate {member_id}: {repr(e)}')
+                    if member_id in self.entries:
+                        self._push_retry(member_id, datetime.utcnow())
+                    continue
+                # Next year, or the changed date if set() was called meanwhile
+                entry = self.entries.get(member_id)
+                if entry is not None:
+                    self._schedule(member_id, entry[0], year)
+                continue
+
+            timeout = self.max_sleep
+            if item is not None:
+                timeout = min(timeout, (item[0] - now).total_seconds())
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,67 @@
+from collections import OrderedDict
+import time
+
+
+_MISSING = object()
+
+
+# Bounded in-process mapping, evicts the least recently used entries. Entries may expire after ttl seconds
+class LRUCache:
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING, count=False) is not _MISSING
+
+    def get(self, key, default=None, count=True):
+        try:
+            expires_at, value = self.data[key]
+        except KeyError:
+            if count:
+                self.misses += 1
+            return default
+        if expires_at is not None and expires_at < time.monotonic():
+            del self.data[key]
+            if count:
+                self.misses += 1
+            return default
+        self.data.move_to_end(key)
+        if count:
+            self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        self.data[key] = (expires_at, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        entry = self.data.pop(key, None)
+        if entry is None:
+            return default
+        return entry[1]
+
+    def clear(self):
+        self.data.clear()
+
+
+# Rendered command replies. Keys are tuples starting with (command, channel_id), channel_id being the channel
+# the data comes from (None if it isn't channel bound), followed by whatever else the reply depends on.
+# invalidate() relies on these two leading items. Entries expire after ttl and are dropped early when the
+# data behind a channel or a command changes
+class RenderCache(LRUCache):
+    def invalidate(self, channel_id=None, command=None):
+        stale = [key for key in self.data
+                 if (channel_id is None or key[1] == channel_id) and (command is None or key[0] == command)]
+        for key in stale:
+            del self.data[key]
@@ -2,27 +2,33 @@ from collections import Counter
 from datetime import timedelta
 from datetime import datetime
 from datetime import date
+from functools import partial
 import asyncio
 import argparse
 import logging
 import logging.handlers
 import os
 import random
-import re
 import time
-import urllib
 
-from discord import Intents
+from discord import Intents, NotFound
 from discord.ext.commands import HelpCommand
 from discord.ext import commands
 from pythonjsonlogger import jsonlogger
 import sentry_sdk
 import yaml
 
-from comrade_db import AsyncDB
-from lastfm import LastRequester
-from videos_meta import parse_title, remove_brackets, remove_unicode
-from youtube import YoutubePlaylists
+from caching import RenderCache
+from comrade_db import LEGACY_GUILD, AsyncDB, GuildSettings
+from lastfm import ArtistCache, LastRequester
+from links import classify_links, find_video_link
+from birthdays import BirthdayScheduler, parse_birthday
+from guild_cache import GuildCache
+from live_stats import LiveStats
+from metrics import METRICS, MetricsServer
+from pipeline import run_pipeline
+from videos_meta import normalize_titles
+from youtube import VideoMetaCache, YoutubePlaylists
 
 # Propper error handling during argparsing
 class ParsingError(Exception):
@@ -32,29 +38,44 @@ class ArgumentParser(argparse.ArgumentParser):
     def error(self, message):
         raise ParsingError(message)
 
+# Settings of the message's guild, None for DMs and guilds which are not configured
+async def get_guild_settings(guild):
+    if guild is None:
+        return None
+    return await db.get_guild(guild.id)
+
+
+# Server admin commands are open to the bot admins and to members who can manage the server
+def is_guild_admin(ctx):
+    if ctx.author.id in bot_admins:
+        return True
+    return ctx.guild is not None and ctx.author.guild_permissions.manage_guild
+
+
 # Check if the message contains valid link and process if it does
-async def check_message(message, allow_copies=True, silent=False):
-    if message.channel.id not in discord_watched_channels:
-        if message.channel.id == archive_channel_id:
-            await process_archive_channel_posting()
+async def check_message(message, allow_copies=True, silent=False, snippets=None):
+    settings = await get_guild_settings(message.guild)
+    if settings is None:
+        return
+    if message.channel.id not in settings.watched_channels:
         return
 
     # Check if the message contains an eligible link and archive
-    provider = is_link(message.content)
-    if provider and provider != 'undefined link':
+    video_link = find_video_link(message.content)
+    if video_link:
         logger.debug(f'Detected video in {message.content}')
-
-        # Clean link
-        link = extract_link(message.content)
-        link, video_id = clean_link(link, provider)
+        provider, link, video_id = video_link
 
         # Check if youtube category is eligible
         video_title = ''
         if provider == 'youtube':
-            video_info = get_youtube_video_info(video_id)
+            if snippets is not None and video_id in snippets:
+                snippet = snippets[video_id]
+            else:
+                snippet = (await get_youtube_snippets([video_id])).get(video_id)
             try:
-                video_title = video_info['items'][0]['snippet']['title']
-                video_category = video_info['items'][0]['snippet']['categoryId']
+                video_title = snippet['title']
+                video_category = snippet['categoryId']
                 if video_category not in eligible_video_categories:
                     logger.info(f"Video from {link} rejected (invalid category)")
                     return
@@ -63,17 +84,18 @@ async def check_message(message, allow_copies=True, silent=False):
                 return
 
         # Check if the link has been already archived
-        is_posted = await db.has_it_been_posted(link, archive_channel_id)
+        is_posted = await db.has_it_been_posted(link, settings.archive_channel)
         if is_posted:
             # Add emoji to duplicate links
             if not silent:
-                for emoji in client.emojis:
-                    if emoji.name == duplicate_emoji:
-                        try:
-                            await message.add_reaction(client.get_emoji(emoji.id))
-                            break
-                        except:
-                            logger.error('Cant find emoji for duplicate links on the server')
+                emoji = guild_cache.emoji(settings.duplicate_emoji, settings.id)
+                if emoji is None:
+                    logger.error('Cant find emoji for duplicate links on the server')
+                else:
+                    try:
+                        await message.add_reaction(emoji)
+                    except:
+                        logger.error('Cant add reaction to the duplicate link')
 
             # Do nothing if copies are not allowed
             if not allow_copies:
@@ -81,95 +103,47 @@ async def check_message(message, allow_copies=True, silent=False):
                 return
 
         # Archive finally
-        await archive_video(message, link, video_title, silent)
-
-
-# Check if the message contains an (eligible) link
-def is_link(content):
-    if 'youtube.com/watch' in content:
-        return 'youtube'
-    elif 'youtu.be/' in content:
-        return 'youtube'
-    elif 'vimeo.com/' in content:
-        return 'vimeo'
-    # At least location + path should be present, eg. 'youtube.com/a'
-    elif re.findall(url_pattern, content):
-        return 'undefined link'
-
-
-# Extract first eligible link from the the message
-def extract_link(content):
-    link = re.findall(url_pattern, content)
-    if link:
-        return link[0]
-    else:
-        logger.error(f'Error extracting link from {content}')
-
-# Get video id and shorten it (for youtube now, but who knows)
-def clean_link(link, provider):
-    if provider == 'youtube':
-        video_id = get_id(link)
-        clean_url = 'https://www.youtube.com/watch?v=' + video_id
-    else:
-        video_id = ''
-        clean_url = link
-    return clean_url, video_id
+        await archive_video(settings, message, link, video_title, silent)
 
 
-# Add video to the database and copy to archive channel
-async def archive_video(message, link, video_title='', silent=False):
+# Add video to the database and copy to the guild's archive channel
+async def archive_video(settings, message, link, video_title='', silent=False):
     video_id = await db.get_video_by_link(link)
     if not video_id:
         video_id = await db.add_video(link, video_title)
-    posted_id = await db.archive_video(video_id, archive_channel_id, message.channel.id, message.author.id, time.strftime(db_timeformat_full))
+    posted_id = await db.archive_video(video_id, settings.archive_channel, message.channel.id, message.author.id, time.strftime(db_timeformat_full))
+    render_cache.invalidate(settings.archive_channel)
     logger.info(f'Video archived: {link}')
     if not silent:
-        await post_video_to_archive_channel(posted_id)
+        await post_video_to_archive_channel(settings, posted_id)
 
 
-async def post_video_to_archive_channel(posted_id):
-    channel = client.get_channel(archive_channel_id)
+async def post_video_to_archive_channel(settings, posted_id):
     post_info = await db.get_archived_video_by_id(posted_id)
     link = post_info[0]
     user_id = post_info[1]
     time_posted = post_info[2]
+    await send_to_archive_channel(settings, link, user_id, time_posted)
+
+
+async def send_to_archive_channel(settings, link, user_id, time_posted):
+    channel = client.get_channel(settings.archive_channel)
     time_posted_struct = datetime.strptime(time_posted, db_timeformat_full)
-    time_posted_local = time_posted_struct + timedelta(hours=utc_time_offset)
-    user_name = 'Someone'
-    for user in channel.members:
-        if user.id == user_id:
-            user_name = user.display_name
+    time_posted_local = time_posted_struct + timedelta(hours=settings.utc_offset)
+    user_name = guild_cache.display_name(channel.guild.id, user_id, 'Someone')
 
     await channel.send(f"{user_name} at {time_posted_local}:")
     await channel.send(link)
     logger.info(f'Video posted to channel: {link}')
 
 
-# Get youtube video id
-def get_id(link):
+# Get snippets for a batch of videos through the metadata cache, {video_id: snippet or None if the video is gone}
+async def get_youtube_snippets(video_ids):
     try:
-        if 'youtube.com/watch?' in link:
-            youtube_query = urllib.parse.urlparse(link).query
-            return urllib.parse.parse_qs(youtube_query)['v'][0]
-        elif 'youtu.be/' in link:
-            youtube_path = urllib.parse.urlparse(link).path
-            return youtube_path[1:]
-        else:
-            logger.error(f'Unknown url pattern at {link}')
+        return await youtube_cache.get_many(video_ids)
     except:
-        logger.error(f'Error getting video id from {link}')
-
-# Get video info
-def get_youtube_video_info(video_id):
-    try:
-        return youtube.get_video_info(video_id)
-    except:
-        logger.error(f'Error retrieving video info {video_id}')
-
-
-# Process vimeo
-async def process_vimeo(message, silent):
-    await archive_video(message, silent)
+        logger.error(f'Error retrieving video info for {len(video_ids)} videos')
+        return {}
 
 
 # Warn user on archive channel posting and clean after delay
@@ -180,100 +154,91 @@ async def process_archive_channel_posting(message):
     logger.info('Cleared random message to archive channel')
 
 
-# Update video titles
+# Update video titles. Streams untitled videos from the database and resolves them in batches
 async def update_video_titles():
-    videos = await db.get_videos()
-    for video in videos:
-        link = video[1]
-        video_title = video[2]
-
-        # Skip videos with titles
-        if video_title:
-            continue
+    async def resolve_titles(videos):
+        youtube_ids = {}
+        for video_id, link in videos:
+            video_link = find_video_link(link)
+            if video_link and video_link.provider == 'youtube':
+                youtube_ids[video_id] = video_link.video_id
+        snippets = await get_youtube_snippets(youtube_ids.values())
+        titles = []
+        for video_id, youtube_id in youtube_ids.items():
+            snippet = snippets.get(youtube_id)
+            if snippet:
+                titles.append((snippet['title'], video_id))
+            else:
+                logger.warning(f'No title for video {youtube_id}')
+        return titles
 
-        if is_link(link) == 'youtube':
-            video_id = get_id(link)
-            video_info = get_youtube_video_info(video_id)
-            try:
-                video_title = video_info['items'][0]['snippet']['title']
-                await db.update_video_title(video_id, video_title)
-            except:
-                logger.warning(f'No title for video {link}')
+    updated = await run_pipeline(db.iter_videos_without_title(enrichment_chunk_size), resolve_titles,
+                                 db.update_video_titles_bulk, enrichment_concurrency)
+    logger.info(f'Updated titles for {updated} videos')
 
 
 # Guess artist
 async def guess_artist():
-    try:
-        lastfm = LastRequester(lastfm_token)
-    except:
-        logger.error('Cant init last.fm connection')
-        return False
-
-    videos = await db.get_videos()
-    for video in videos:
-        video_id = video[0]
-        link = video[1]
-        video_title = video[2]
-        artist = video[3]
-
-        # Skip videos which already have artist parsed
-        if artist:
-            continue
-        # Skip videos without titles
-        if not video_title:
-            continue
-
-        # Try to parse the title
-        parsed_artist = parse_title(video_title)
-        if not parsed_artist:
-            logger.debug(f'Failed to parse {link}')
-            continue
-
-        # Clean the parsed title
-        clean_artist = []
-        for _ in parsed_artist:
-            clean = remove_unicode(_)
-            clean = remove_brackets(clean)
-            clean = clean.strip()
-            clean_artist.append(clean)
-        artist = clean_artist[0]
-        title = clean_artist[1]
-
-        # Check if such artist exists on last.fm
-        if not lastfm.check_artist(artist):
-            logger.debug(f'Cant find {artist} on lastfm')
-            continue
-
-        # Update database finally
-        await db.enrich_video(video_id, artist, title)
-        logger.debug(f'Enriched {link} as {artist} - {title}')
+    async def resolve_artists(videos):
+        candidates = []
+        for (video_id, link, video_title), parsed in zip(videos, normalize_titles(video[2] for video in videos)):
+            if parsed is None:
+                logger.debug(f'Failed to parse {link}')
+                continue
+            candidates.append((video_id, link, parsed[0], parsed[1]))
+
+        # Check if such artists exist on last.fm, several at once within the rate limit
+        artists = list({candidate[2] for candidate in candidates})
+        found = dict(zip(artists, await gather_bounded(check_artist_lastfm, artists, lastfm_concurrency)))
+
+        enriched = []
+        for video_id, link, artist, title in candidates:
+            if not found[artist]:
+                logger.debug(f'Cant find {artist} on lastfm')
+                continue
+            enriched.append((artist, title, video_id))
+            logger.debug(f'Enriched {link} as {artist} - {title}')
+        return enriched
+
+    enriched = await run_pipeline(db.iter_videos_without_artist(enrichment_chunk_size), resolve_artists,
+                                  db.enrich_videos_bulk, enrichment_concurrency)
+    logger.info(f'Enriched {enriched} videos. Last.fm cache stats: {lastfm_cache.stats()}')
 
 
 # Get top tags for videos from lastfm
 async def get_tags_lastfm():
+    async def resolve_tags(videos):
+        artists = list({artist for video_id, artist in videos})
+        found = dict(zip(artists, await gather_bounded(check_artist_lastfm, artists, lastfm_concurrency)))
+        tags = []
+        for video_id, artist in videos:
+            for tag in found[artist] or []:
+                tags.append((video_id, tag))
+        return tags
+
+    tagged = await run_pipeline(db.iter_videos_without_tags(enrichment_chunk_size), resolve_tags,
+                                db.add_tags_bulk, enrichment_concurrency)
+    logger.info(f'Added {tagged} tags. Last.fm cache stats: {lastfm_cache.stats()}')
+
+
+# Get artist top tags from last.fm, False if not found or last.fm is unavailable
+async def check_artist_lastfm(artist):
     try:
-        lastfm = LastRequester(lastfm_token)
-    except:
-        logger.error('Cant init last.fm connection')
+        return await lastfm.check_artist(artist)
+    except UserWarning:
+        logger.error(f'Last.fm lookup failed for {artist}')
         return False
 
-    videos = await db.get_videos()
-    for video in videos:
-        video_id = video[0]
-        artist = video[3]
 
-        # Skip videos without artists
-        if not artist:
-            continue
+# Run coroutine function over items with no more than `limit` of them at once, results in items order
+async def gather_bounded(func, items, limit):
+    semaphore = asyncio.Semaphore(limit)
 
-        # Skip videos which have tags
-        if await db.check_video_tags(video_id):
-            continue
+    async def run(item):
+        async with semaphore:
+            return await func(item)
 
-        top_tags = lastfm.check_artist(artist)
-        if top_tags:
-            for tag in top_tags:
-                await db.add_tag(video_id, tag)
+    return await asyncio.gather(*(run(item) for item in items))
 
 
 # Load custom help file 'help.txt'
@@ -291,6 +256,18 @@ class CustomHelp(HelpCommand):
             await self.context.send(part)
 
 
+# Close the shared database connections and http sessions on shutdown
+class ComradeBot(commands.AutoShardedBot):
+    async def close(self):
+        await super().close()
+        await live_stats.flush()
+        await lastfm.close()
+        await metrics_server.stop()
+        if youtube:
+            youtube.close()
+        await db.close()
+
+
 # MAIN
 # Load config
 with open('config.yaml', 'r', encoding="utf-8") as configfile:
@@ -307,6 +284,8 @@ os.environ['PYTHONASYNCIODEBUG'] = '1'
 
 # Setup logging
 logging_level = cfg['debug']['debug level']
+metrics_host = cfg['debug'].get('metrics host', '127.0.0.1')
+metrics_port = cfg['debug'].get('metrics port', 9108)
 formatter = jsonlogger.JsonFormatter('%(asctime)s %(levelname)s: %(message)s')
 
 handler = logging.handlers.RotatingFileHandler('comrade.log', mode='a', maxBytes=10485760, backupCount=0, encoding='utf-8')
@@ -324,39 +303,82 @@ logger.info('Session started')
 client_secrets_file = cfg['youtube']['client secrets file']
 credentials_file = cfg['youtube']['credentials file']
 
+youtube_max_workers = cfg['youtube'].get('max workers', 4)
+youtube_timeout = cfg['youtube'].get('timeout', 10)
+youtube_cache_size = cfg['youtube'].get('cache size', 10000)
+youtube_refresh_age = cfg['youtube'].get('cache refresh days', 7) * 24 * 3600
+
 try:
-    youtube = YoutubePlaylists(client_secrets_file, credentials_file)
+    youtube = YoutubePlaylists(client_secrets_file, credentials_file, youtube_max_workers, youtube_timeout)
 except:
+    youtube = None
     logger.error('Youtube connection error')
 
 # Init and configure discord bot
 discord_token = cfg['bot']['bot token']
-discord_watched_channels = cfg['bot']['watched channels']
-archive_channel_id = cfg['bot']['target video channel']
+shard_count = cfg['bot'].get('shard count')
+# Single guild settings of older configs. The guild of the archive channel is configured with them
+# on the first start, guilds are configured with the configure command otherwise
+discord_watched_channels = [channel for channel in cfg['bot'].get('watched channels') or [] if channel]
+archive_channel_id = cfg['bot'].get('target video channel')
 eligible_video_categories = cfg['youtube']['eligible categories']
-utc_time_offset = cfg['bot']['utc time offset']
+# Also the default for newly configured guilds
+utc_time_offset = cfg['bot'].get('utc time offset', 0)
 command_prefix = cfg['bot']['command prefix']
 ok_reply = cfg['bot']['ok reply']
 archive_posting_warning = cfg['bot']['archive posting warning']
 bot_admins = cfg['bot']['admin users']
 allow_copies = cfg['bot']['allow copies in archive']
-duplicate_emoji = cfg['bot']['duplicacte emoji']
+duplicate_emoji = cfg['bot'].get('duplicacte emoji')
 archive_depth = cfg['bot']['archive depth']
-url_pattern = cfg['bot']['url pattern']
+archive_repost_interval = cfg['bot'].get('archive repost interval', 1.0)
+wipe_delete_interval = cfg['bot'].get('wipe delete interval', 1.0)
+wipe_progress_interval = cfg['bot'].get('wipe progress interval', 10)
 max_pips = cfg['bot']['max pips in report']
+render_cache_ttl = cfg['bot'].get('render cache ttl', 30)
+render_cache_size = cfg['bot'].get('render cache size', 256)
+enrichment_chunk_size = cfg['bot'].get('enrichment chunk size', 200)
+enrichment_concurrency = cfg['bot'].get('enrichment concurrency', 4)
 db_path = cfg['database']['path']
 db_init_script = cfg['database']['init_script']
+db_pragmas = {pragma: cfg['database'][pragma] for pragma in ('journal_mode', 'synchronous', 'cache_size', 'mmap_size', 'busy_timeout') if pragma in cfg['database']}
+db_cached_statements = cfg['database'].get('cached_statements', 128)
+db_write_batch = cfg['database'].get('write_batch', 200)
+db_write_delay = cfg['database'].get('write_delay', 0)
 db_timeformat_full = '%Y-%m-%d %H:%M:%S'
 birthday_report_time = cfg['database']['birthday_report_time']
 check_frequency = cfg['database']['check_frequency']
+name_sync_concurrency = cfg['database'].get('name_sync_concurrency', 4)
+stats_flush_interval = cfg['database'].get('stats_flush_interval', 60)
+stats_scan_concurrency = cfg['database'].get('stats_scan_concurrency', 2)
 lastfm_token = cfg['lastfm']['token']
+lastfm_rate_limit = cfg['lastfm'].get('rate limit', 5)
+lastfm_concurrency = cfg['lastfm'].get('max concurrency', 4)
+lastfm_cache_ttl = cfg['lastfm'].get('cache ttl days', 30) * 24 * 3600
+lastfm_negative_cache_ttl = cfg['lastfm'].get('negative cache ttl days', 7) * 24 * 3600
+lastfm_cache_size = cfg['lastfm'].get('cache size', 4096)
 
 intents = Intents().default()
 intents.members = True
 
 helpme = CustomHelp()
-client = commands.Bot(command_prefix=command_prefix, help_command=helpme, intents=intents)
-db = AsyncDB(db_path, db_init_script)
+client = ComradeBot(command_prefix=command_prefix, help_command=helpme, intents=intents, shard_count=shard_count)
+db = AsyncDB(db_path, db_init_script, db_pragmas, db_cached_statements, db_write_batch, db_write_delay)
+live_stats = LiveStats(db)
+guild_cache = GuildCache()
+render_cache = RenderCache(render_cache_size, render_cache_ttl)
+# guild id -> BirthdayScheduler, each guild has its own timezone
+birthday_schedulers = {}
+# guild id -> task running the guild's scheduler
+birthday_tasks = {}
+# Set once on_ready has configured the legacy guild, background tasks wait for it
+guilds_ready = asyncio.Event()
+# Watched channels whose startup catch-up has not succeeded (yet), the daily flag move skips them
+stats_catching_up = set()
+metrics_server = MetricsServer(metrics_host, metrics_port)
+youtube_cache = VideoMetaCache(youtube, db, youtube_cache_size, youtube_refresh_age)
+lastfm_cache = ArtistCache(db, lastfm_cache_ttl, lastfm_negative_cache_ttl, lastfm_cache_size)
+lastfm = LastRequester(lastfm_token, rate_limit=lastfm_rate_limit, max_connections=lastfm_concurrency, cache=lastfm_cache)
 
 
 # TRIGGERS AND COMMANDS
@@ -364,11 +386,36 @@ db = AsyncDB(db_path, db_init_script)
 async def on_ready():
     # Log status on connect
     logger.info('Logged in as {0.user}'.format(client))
-    for channel in discord_watched_channels:
-        watched_channel = client.get_channel(channel)
-        logger.info(f'Watching [{watched_channel.name}] on [{watched_channel.guild}]')
-    video_channel = client.get_channel(archive_channel_id)
-    logger.info(f'Will copy videos to [{video_channel.name}] on [{video_channel.guild}]')
+    await db.connect()
+    guild_cache.load(client.guilds)
+    logger.info(f'Cached {sum(len(members) for members in guild_cache.guild_members.values())} members and '
+                f'{sum(len(emojis) for emojis in guild_cache.guild_emojis.values())} emojis')
+    await adopt_legacy_config()
+    guilds = await db.get_guilds()
+    logger.info(f'Serving {len(guilds)} configured guilds of {len(client.guilds)} on {client.shard_count} shards')
+    await load_birthday_schedulers()
+    guilds_ready.set()
+
+
+# Older configs describe a single guild: the guild of the archive channel gets these settings unless it
+# has its own, and the members stored before the guilds migration
+async def adopt_legacy_config():
+    if not archive_channel_id:
+        return
+    channel = client.get_channel(archive_channel_id)
+    if channel is None:
+        logger.error(f'Cant find archive channel {archive_channel_id} from config')
+        return
+    guild_id = channel.guild.id
+    if await db.get_guild(guild_id) is None:
+        congrats_channel = discord_watched_channels[0] if discord_watched_channels else None
+        await db.set_guild(guild_id, archive_channel_id, congrats_channel, duplicate_emoji, utc_time_offset)
+        for watched_channel in discord_watched_channels:
+            await db.watch_channel(guild_id, watched_channel)
+        logger.info(f'Guild {guild_id} configured from config.yaml')
+    if await db.get_members(LEGACY_GUILD):
+        await db.adopt_legacy_members(guild_id)
+        logger.info(f'Members stored before the guilds migration moved to guild {guild_id}')
 
 
 @client.event
@@ -380,13 +427,103 @@ async def on_message(message):
     if message.author == client.user:
         return
 
+    # Only configured guilds are served
+    settings = await get_guild_settings(message.guild)
+    if settings is None:
+        return
+
     # Process random posts to archive channel
-    if message.channel.id == archive_channel_id:
+    if message.channel.id == settings.archive_channel:
         await process_archive_channel_posting(message)
         return
 
+    # Count the message for stats
+    message_date = datetime.date(message.created_at + timedelta(hours=settings.utc_offset))
+    live_stats.add(settings.id, message.channel.id, message_date, message.author.id, message.created_at)
+
     # Check the new message and archive if it is eligible music video
-    await check_message(message, allow_copies=allow_copies)
+    if settings.archive_channel:
+        await check_message(message, allow_copies=allow_copies)
+
+
+# Keep the guild cache current
+@client.event
+async def on_member_join(member):
+    guild_cache.add_member(member)
+    await sync_member_name(member)
+
+
+@client.event
+async def on_member_remove(member):
+    guild_cache.remove_member(member)
+
+
+@client.event
+async def on_member_update(before, after):
+    guild_cache.add_member(after)
+    await sync_member_name(after)
+
+
+# Display names without a nickname come from the user
+@client.event
+async def on_user_update(before, after):
+    for guild in client.guilds:
+        member = guild.get_member(after.id)
+        if member is not None:
+            guild_cache.add_member(member)
+    await sync_member_name(after)
+
+
+@client.event
+async def on_guild_emojis_update(guild, before, after):
+    guild_cache.update_emojis(guild, after)
+
+
+@client.event
+async def on_guild_join(guild):
+    guild_cache.add_guild(guild)
+
+
+# A guild the bot has left is unconfigured, it is set up again with the configure command if the bot comes back
+@client.event
+async def on_guild_remove(guild):
+    guild_cache.remove_guild(guild)
+    if await db.get_guild(guild.id) is None:
+        return
+    await db.remove_guild(guild.id)
+    birthday_schedulers.pop(guild.id, None)
+    task = birthday_tasks.pop(guild.id, None)
+    if task is not None:
+        task.cancel()
+    render_cache.clear()
+    logger.info(f'Left guild {guild.id}, its settings are removed')
+
+
+# Deleted channels are unwatched and unset as the archive or congratulations channel
+@client.event
+async def on_guild_channel_delete(channel):
+    settings = await db.get_guild(channel.guild.id)
+    if settings is None:
+        return
+    if channel.id in settings.watched_channels:
+        await db.unwatch_channel(settings.id, channel.id)
+    if channel.id in (settings.archive_channel, settings.congrats_channel):
+        archive_channel = None if settings.archive_channel == channel.id else settings.archive_channel
+        congrats_channel = None if settings.congrats_channel == channel.id else settings.congrats_channel
+        await db.set_guild(settings.id, archive_channel, congrats_channel, settings.duplicate_emoji, settings.utc_offset)
+    render_cache.invalidate(channel.id)
+    logger.info(f'Channel {channel.id} of guild {settings.id} deleted, settings: {await db.get_guild(settings.id)}')
+
+
+# Time every command
+@client.before_invoke
+async def start_command_timer(ctx):
+    ctx.started = time.perf_counter()
+
+
+@client.after_invoke
+async def record_command_time(ctx):
+    METRICS.observe('command', ctx.command.qualified_name, time.perf_counter() - ctx.started, ctx.command_failed)
 
 
 # Scan X last messages and archive eligible, which have not been archived before
@@ -394,13 +531,16 @@ async def on_message(message):
 async def archive(ctx, *, args=''):
     # Get channel history
     logger.debug('Got archive command')
-    if ctx.author.id not in bot_admins:
-        logger.info('Not an admin, rejected')
+    if not is_guild_admin(ctx):
+        logger.info(f'{ctx.author.id} is not an admin, rejected archive command')
+        return
 
     parser = ArgumentParser()
     parser.add_argument('-d', '--depth', type=int, default=None)
     parser.add_argument('-f', '--from_id', type=int, default=0)
     parser.add_argument('-s', '--silent', type=bool, default=False)
+    parser.add_argument('-b', '--backfill', action='store_true')
+    parser.add_argument('-r', '--repost', action='store_true')
     try:
         args = parser.parse_args(args.split())
     except ParsingError as e:
@@ -408,36 +548,182 @@ async def archive(ctx, *, args=''):
         await ctx.send(e)
         return
 
+    if args.backfill:
+        settings = await get_guild_settings(ctx.guild)
+        if settings is None or ctx.channel.id not in settings.watched_channels:
+            logger.info('Channel is not watched, rejected backfill')
+            await ctx.send('This channel is not watched')
+            return
+        await ctx.send(await backfill_archive(settings, ctx.channel, args.depth, args.from_id, args.repost))
+        return
+
     ctx_history = await ctx.history(limit=args.depth, oldest_first=True).flatten()
     ctx_history = [message for message in ctx_history if message.id > args.from_id]
     logger.debug(f'Loaded {len(ctx_history)} historic messages from context channel')
 
+    # Resolve youtube metadata for the whole range in batches
+    youtube_ids = []
+    for message in ctx_history:
+        video_link = find_video_link(message.content)
+        if video_link and video_link.provider == 'youtube':
+            youtube_ids.append(video_link.video_id)
+    snippets = await get_youtube_snippets(youtube_ids)
+
     # Check all messages in channel and archive music videos which are not in the archive
     for message in ctx_history:
-        await check_message(message, allow_copies=False, silent=args.silent)
+        await check_message(message, allow_copies=False, silent=args.silent, snippets=snippets)
 
     await ctx.send(ok_reply)
 
 
-# Wipe all messages from the archive channel
+# Backfill the archive from channel history in phases: collect unique links (the oldest post of each wins),
+# resolve metadata in batches, check them against the archive with one query and store the new ones in
+# one transaction. Duplicates get no reactions, reposting to the archive channel is optional and paced
+async def backfill_archive(settings, channel, depth, from_id=0, repost=False):
+    started = time.monotonic()
+    scanned = 0
+    first_posts = {}
+    async for message in channel.history(limit=depth, oldest_first=True):
+        if message.id <= from_id:
+            continue
+        scanned += 1
+        video_link = find_video_link(message.content)
+        if video_link and video_link.url not in first_posts:
+            first_posts[video_link.url] = (video_link, message)
+    logger.info(f'Backfill scanned {scanned} messages in {channel.id}, found {len(first_posts)} unique links')
+
+    snippets = await get_youtube_snippets([video_link.video_id for video_link, message in first_posts.values()
+                                           if video_link.provider == 'youtube'])
+    known = await db.get_archive_status(list(first_posts), settings.archive_channel)
+
+    rows = []
+    rejected = 0
+    for link, (video_link, message) in first_posts.items():
+        if link in known and known[link][1]:
+            continue
+        video_title = ''
+        if video_link.provider == 'youtube':
+            snippet = snippets.get(video_link.video_id)
+            if not snippet or snippet.get('categoryId') not in eligible_video_categories:
+                logger.debug(f'Video from {link} rejected (invalid category or deleted)')
+                rejected += 1
+                continue
+            video_title = snippet['title']
+        rows.append((link, video_title, channel.id, message.author.id, message.created_at.strftime(db_timeformat_full)))
+
+    if rows:
+        await db.archive_videos_bulk(rows, settings.archive_channel)
+        render_cache.invalidate(settings.archive_channel)
+    logger.info(f'Backfill archived {len(rows)} videos in {time.monotonic() - started:.1f}s')
+
+    if repost:
+        for link, video_title, source_channel, user_id, date_posted in rows:
+            await send_to_archive_channel(settings, link, user_id, date_posted)
+            await asyncio.sleep(archive_repost_interval)
+
+    return (f'Scanned {scanned} messages: {len(first_posts)} unique links, {len(rows)} archived, '
+            f'{len(first_posts) - len(rows) - rejected} already in the archive, {rejected} rejected')
+
+
+# Wipe all messages from the archive channel. History is streamed, messages younger than 14 days are
+# bulk deleted by 100, older ones go through a paced queue of single deletes. Archive records of the
+# deleted links are removed afterwards, progress is reported by editing a status message
 @client.command()
 async def wipe_archive(ctx):
     logger.info('Got wipe archive command')
-    if ctx.author.id not in bot_admins:
-        logger.info('Not an admin, rejected')
-    chan = client.get_channel(archive_channel_id)
-    hist = await chan.history(limit=archive_depth).flatten()
-    for message in hist:
-        logger.info(f'Deleting message: {message.content}')
-        await message.delete()
+    if not is_guild_admin(ctx):
+        logger.info(f'{ctx.author.id} is not an admin, rejected wipe_archive command')
+        return
+    settings = await get_guild_settings(ctx.guild)
+    if settings is None or not settings.archive_channel:
+        await ctx.send('No archive channel configured for this server')
+        return
+    channel = client.get_channel(settings.archive_channel)
+    status = await ctx.send('Wiping the archive channel...')
+    progress = {'scanned': 0, 'deleted': 0, 'failed': 0}
+    deleted_links = {}
+    old_messages = asyncio.Queue(maxsize=1000)
+    # Bulk delete rejects messages older than 14 days, keep a margin for the time the wipe takes
+    bulk_cutoff = datetime.utcnow() - timedelta(days=14) + timedelta(hours=1)
+    last_report = time.monotonic()
+
+    def mark_deleted(messages):
+        progress['deleted'] += len(messages)
+        for message in messages:
+            for link in classify_links(message.content):
+                deleted_links[link.url] = None
+
+    async def report_progress():
+        nonlocal last_report
+        if time.monotonic() - last_report < wipe_progress_interval:
+            return
+        last_report = time.monotonic()
+        try:
+            await status.edit(content=f"Wiping the archive channel: {progress['scanned']} scanned, "
+                                      f"{progress['deleted']} deleted, {old_messages.qsize()} queued")
+        except:
+            logger.error('Cant update wipe_archive progress')
 
-    await ctx.send(ok_reply)
+    async def delete_old():
+        while True:
+            message = await old_messages.get()
+            if message is None:
+                break
+            try:
+                await message.delete()
+                mark_deleted([message])
+            except NotFound:
+                mark_deleted([message])
+            except Exception as e:
+                logger.error(f'Cant delete message {message.id}: {repr(e)}')
+                progress['failed'] += 1
+            await asyncio.sleep(wipe_delete_interval)
+
+    async def delete_chunk(chunk):
+        try:
+            await channel.delete_messages(chunk)
+            mark_deleted(chunk)
+        except Exception as e:
+            # Eg. some of them were already deleted, retry one by one
+            logger.error(f'Bulk delete of {len(chunk)} messages failed: {repr(e)}')
+            for message in chunk:
+                await old_messages.put(message)
+
+    deleter = asyncio.ensure_future(delete_old())
+    try:
+        chunk = []
+        async for message in channel.history(limit=archive_depth):
+            if message.id == status.id:
+                continue
+            progress['scanned'] += 1
+            if message.created_at > bulk_cutoff:
+                chunk.append(message)
+                if len(chunk) == 100:
+                    await delete_chunk(chunk)
+                    chunk = []
+            else:
+                await old_messages.put(message)
+            await report_progress()
+        if chunk:
+            await delete_chunk(chunk)
+    finally:
+        await old_messages.put(None)
+        await deleter
+        await db.unarchive_links(list(deleted_links), settings.archive_channel)
+        render_cache.invalidate(settings.archive_channel)
+
+    logger.info(f"Archive wiped: {progress}, {len(deleted_links)} links unarchived")
+    await status.edit(content=f"Archive channel wiped: {progress['deleted']} of {progress['scanned']} messages deleted, "
+                              f"{progress['failed']} failed, {len(deleted_links)} links removed from the archive")
 
 
 # Scan last messages and force-archive all urls
 @client.command()
 async def force(ctx, *, args):
     logger.info('Got force command')
+    if not is_guild_admin(ctx):
+        logger.info(f'{ctx.author.id} is not an admin, rejected force command')
+        return
 
     parser = ArgumentParser()
     parser.add_argument('-d', '--depth', type=int, default=None)
@@ -450,16 +736,18 @@ async def force(ctx, *, args):
 
     if args.depth == 'last':
         args.depth = 1
-    if ctx.channel.id not in discord_watched_channels:
+    settings = await get_guild_settings(ctx.guild)
+    if settings is None or ctx.channel.id not in settings.watched_channels:
         logger.info('Channel is not watched, rejected')
         return
 
     ctx_history = await ctx.history(limit=int(args.depth) + 1).flatten()
     for message in ctx_history:
-        if is_link(message.content):
-            link = extract_link(message.content)
+        links = classify_links(message.content)
+        if links:
+            link = links[0].url
             logger.debug(f'Force-archiving message {link}')
-            await archive_video(message, link)
+            await archive_video(settings, message, link)
 
 
 # Post simple report (number of links in archive per user or number of posts in current watched channel per user)
@@ -478,26 +766,42 @@ async def report(ctx, *, args=''):
         await ctx.send(e)
         return
 
+    # Same arguments within the ttl get the rendered reply back, live counters can lag that much
+    settings = await get_guild_settings(ctx.guild)
+    if args.channel == 'archive' and (settings is None or not settings.archive_channel):
+        await ctx.send('No archive channel configured for this server')
+        return
+    data_channel_id = settings.archive_channel if args.channel == 'archive' else ctx.channel.id
+    guild_id = ctx.guild.id if ctx.guild else None
+    cache_key = ('report', data_channel_id, guild_id, args.channel, args.depth, args.sort)
+    cached = render_cache.get(cache_key)
+    if cached is not None:
+        await ctx.send(cached)
+        return
+
+    # Days are local to the guild, as stats are stored
+    today = local_date(datetime.utcnow(), settings.utc_offset if settings else utc_time_offset)
     if args.depth == 0:
         date_from = datetime.min.date()
     else:
-        date_from = date.today() - timedelta(days=args.depth)
-    date_to = date.today()
+        date_from = today - timedelta(days=args.depth)
+    date_to = today
 
     # Switch data based on report type
     if args.channel == 'this':
-        await update_message_stats('today', ctx.channel.id)
-        stats = await db.get_stats(ctx.channel.id, date_from, date_to)
+        # Stored stats plus live counters which have not been flushed yet
+        stats = Counter(dict(await db.get_stats(ctx.channel.id, date_from, date_to)))
+        stats.update(live_stats.get_pending(ctx.channel.id, date_from, date_to))
         first_message_date = await db.check_stat_firstdate(ctx.channel.id)
 
-        if ctx.channel.id in discord_watched_channels:
+        if settings is not None and ctx.channel.id in settings.watched_channels:
             channel_type = 'watched'
         else:
             channel_type = 'unwatched'
         report_title = 'Current channel report'
     elif args.channel == 'archive':
-        stats = await db.get_archive_stats(archive_channel_id, date_from, date_to)
-        first_message_date = await db.check_archive_stats_firstdate(archive_channel_id)
+        stats = await db.get_archive_stats(settings.archive_channel, date_from, date_to)
+        first_message_date = await db.check_archive_stats_firstdate(settings.archive_channel)
 
         channel_type = 'archive'
         report_title = 'Archive channel report'
@@ -505,7 +809,7 @@ async def report(ctx, *, args=''):
         logger.error(f'Unrecognized channel: {args.channel}')
         return
 
-    active_members = [member.id for member in ctx.channel.members]
+    active_members = guild_cache.members(guild_id)
     posters = {}
     total_messages = 0
     inactive_member_messages = 0
@@ -513,12 +817,12 @@ async def report(ctx, *, args=''):
     for key in stats:
         total_messages += stats[key]
         if key in active_members:
-            posters[client.get_user(key).display_name] = stats[key]
+            posters[active_members[key][0]] = stats[key]
         else:
             inactive_member_messages += stats[key]
     posters['Inactive members'] = inactive_member_messages
 
-    days_alive = (date.today() - datetime.strptime(first_message_date, "%Y-%m-%d").date()).days
+    days_alive = (today - datetime.strptime(first_message_date, "%Y-%m-%d").date()).days
     if args.depth != 0 and args.depth <= days_alive:
         report_period = args.depth
     else:
@@ -543,6 +847,7 @@ async def report(ctx, *, args=''):
     report += format_members_list(posters, args.sort)
     report.append('```')
     report_string = '\n'.join(report)
+    render_cache.set(cache_key, report_string)
     await ctx.send(report_string)
 
 
@@ -578,8 +883,9 @@ def format_members_list(poster_stats, sorting_field):
 @client.command()
 async def update_stats(ctx, *, args=''):
     logger.info('Got update_stats command')
-    if ctx.author.id not in bot_admins:
+    if not is_guild_admin(ctx):
         logger.info(f'{ctx.author.id} is not an admin, rejected update_stats command')
+        return
 
     parser = ArgumentParser()
     parser.add_argument('-c', '--channel', default='this')
@@ -611,93 +917,146 @@ async def update_stats(ctx, *, args=''):
     if args.mode == 'all':
         await ctx.send(ok_reply)
 
+# Rescan channel history and rewrite message stats (all/today/specific date). The scan takes over from the
+# live counters, which keep counting (and flushing) messages created after it started
 async def update_message_stats(mode, channel_id):
+    if mode not in ('all', 'today') and not isinstance(mode, date):
+        logger.error(f'Unrecognized mode: {mode}')
+        return
+    channel = client.get_channel(channel_id)
+    if channel is None:
+        logger.error(f'Cant find channel {channel_id}, stats are not updated')
+        return
+    settings = await get_guild_settings(channel.guild)
+    utc_offset = settings.utc_offset if settings else utc_time_offset
+
+    # Days the scan rewrites and the wipe of their stored rows, the scan adds to whatever is flushed later
+    def prepare(until):
+        if mode == 'all':
+            return (lambda day: True), db.wipe_stats(channel_id)
+        if mode == 'today':
+            today = local_date(until, utc_offset)
+            return (lambda day: day >= today), db.wipe_stats_current_day(channel_id, today)
+        return (lambda day: day == mode), db.wipe_stats_current_day(channel_id, mode)
+
+    until = await live_stats.rescan(channel_id, prepare)
+
+    limit = None
     if mode == 'all':
-        limit = None
-        before = None
+        before = until
         after = None
-        await db.wipe_stats(channel_id)
     elif mode == 'today':
-        limit = 5000
-        before = datetime.now()
-        after = datetime.combine(date.today(), datetime.max.time()) - timedelta(hours=utc_time_offset)
+        before = until
+        after = local_day_start(local_date(until, utc_offset), utc_offset)
         logger.debug(f'Update mode "today". From {after.strftime("%Y-%m-%d %H:%M")} to {before.strftime("%Y-%m-%d %H:%M")}')
-        await db.wipe_stats_current_day(channel_id, datetime.date(before))
     else:
-        if not isinstance(mode, date):
-            logger.error(f'Unrecognized mode: {mode}')
-            return
-        limit = 5000
-        before = datetime.combine(mode, datetime.max.time()) - timedelta(hours=utc_time_offset)
-        after = before - timedelta(days=1)
+        after = local_day_start(mode, utc_offset)
+        before = local_day_start(mode + timedelta(days=1), utc_offset)
         logger.debug(f'Update mode {mode}. From {after.strftime("%Y-%m-%d %H:%M")} to {before.strftime("%Y-%m-%d %H:%M")}')
-        await db.wipe_stats_current_day(channel_id, datetime.date(before))
-
-    channel = client.get_channel(channel_id)
-    history = await channel.history(limit=limit, after=after, before=before, oldest_first=True).flatten()
 
+    # Stream the history and write each day as soon as it is complete, only one day of counters is kept
     date_pointer = datetime.min.date()
     stats = {}
-    for message in history:
+    async for message in channel.history(limit=limit, after=after, before=before, oldest_first=True):
         if message.author.id == client.user.id:
             continue
-        message_date = datetime.date(message.created_at + timedelta(hours=utc_time_offset))
+        message_date = datetime.date(message.created_at + timedelta(hours=utc_offset))
         if message_date != date_pointer:
-            await commit_daily_stats(stats, date_pointer, channel_id)
+            await commit_daily_stats(stats, date_pointer, channel)
             stats.clear()
             date_pointer = message_date
         if message.author.id not in stats:
             stats[message.author.id] = 1
         else:
             stats[message.author.id] += 1
-    await commit_daily_stats(stats, date_pointer, channel_id)
+    await commit_daily_stats(stats, date_pointer, channel)
 
     if mode in ('all', 'today'):
-        flag_value = (datetime.now() + timedelta(hours=utc_time_offset) - timedelta(days=1)).date()
-    else:
-        flag_value = before.date()
-    if await db.get_flag('last_stat_update', channel_id):
-        await db.update_flag('last_stat_update', channel_id, flag_value)
+        flag_value = (until + timedelta(hours=utc_offset) - timedelta(days=1)).date()
     else:
-        await db.add_flag('last_stat_update', channel_id, flag_value)
+        flag_value = mode
+    await db.set_flag('last_stat_update', channel_id, flag_value)
+    render_cache.invalidate(channel_id)
 
     logger.debug(f'Database update complete. Mode: {mode}')
 
-# Send message stats to the database
-async def commit_daily_stats(stats, date_pointer, channel_id):
+# UTC time when the local (UTC + utc_offset hours) day starts
+def local_day_start(day, utc_offset):
+    return datetime.combine(day, datetime.min.time()) - timedelta(hours=utc_offset)
+
+
+# Local date of a naive UTC time
+def local_date(moment, utc_offset):
+    return (moment + timedelta(hours=utc_offset)).date()
+
+
+# Send one day of message stats to the database in a single bulk write, new posters become members of the guild.
+# Counts are added: the day was wiped before the scan and live counters may have flushed newer messages since
+async def commit_daily_stats(stats, date_pointer, channel):
     if not stats:
         return
-    if date_pointer == await db.check_stat_lastdate(channel_id):
-        logger.error(f'The date {date_pointer} has been already reported, terminated the update')
-    members = await db.get_members()
-    for key in stats:
-        if key not in members:
-            await db.add_member(key)
-        if not await db.check_stat_pk(channel_id, date_pointer, key):
-            await db.add_stat(channel_id, datetime.strftime(date_pointer, "%Y-%m-%d"), key, stats[key])
-        else:
-            logger.error(f"Failed to write duplicate stat for {date_pointer} - {key}")
-
-# Update stats daily
+    date_string = datetime.strftime(date_pointer, "%Y-%m-%d")
+    stats_rows = [(channel.id, date_string, key, stats[key]) for key in stats]
+    guild_id = channel.guild.id
+    new_members = [(guild_id, member_id) for member_id in await db.missing_members(guild_id, stats)]
+    await db.add_stats_bulk(stats_rows, new_members, accumulate=True)
+
+# Keep message stats current. At startup rescan what was missed while the bot was offline (or everything,
+# if stats were never collected), then flush live counters periodically and move the update flag daily.
+# Catch-up scans run in the background, live counters are flushed meanwhile
 async def update_stats_daily():
-    await client.wait_until_ready()
-    db = AsyncDB(db_path, db_init_script)
+    await guilds_ready.wait()
+    live_since = live_stats.start()
+    # guild id -> local date, days change at different times in different guilds
+    guilds = await db.get_guilds()
+    current_dates = {settings.id: local_date(live_since, settings.utc_offset) for settings in guilds}
+    watched_channels = [channel for settings in guilds for channel in settings.watched_channels]
+    stats_catching_up.update(watched_channels)
+    client.loop.create_task(gather_bounded(catch_up_stats, watched_channels, stats_scan_concurrency))
+
     while not client.is_closed():
-        for watched_channel in discord_watched_channels:
-            current_date = (datetime.now() + timedelta(hours=3)).date()
-            last_stat_update = await db.get_flag('last_stat_update', watched_channel)
-
-            if last_stat_update:
-                last_stat_update_date = datetime.strptime(last_stat_update, "%Y-%m-%d").date()
-                date_difference = current_date - last_stat_update_date
-                iterdates = (last_stat_update_date + timedelta(n + 1) for n in range(date_difference.days - 1))
-                for date_to_update in iterdates:
-                    await update_message_stats(date_to_update, watched_channel)
-            else:
-                logger.info('Cant find "last_stat_update" flag. Updating usin "all" mode')
-                await update_message_stats('all', watched_channel)
+        await asyncio.sleep(stats_flush_interval)
+        try:
+            await live_stats.flush()
+        except:
+            logger.error('Failed to flush live message stats')
+            continue
 
-        await asyncio.sleep(check_frequency)
+        # Days passed while running are fully covered by live counters. Guilds configured since the start
+        # begin counting from today, their channels were scanned when they were added
+        now = datetime.utcnow()
+        for settings in await db.get_guilds():
+            today = local_date(now, settings.utc_offset)
+            if current_dates.setdefault(settings.id, today) != today:
+                current_dates[settings.id] = today
+                for watched_channel in settings.watched_channels - stats_catching_up:
+                    await db.set_flag('last_stat_update', watched_channel, today - timedelta(days=1))
+
+# Rescan the days a watched channel missed: from the last update flag to today, or the whole history.
+# Channels which were deleted or can't be read anymore are skipped, their update flags stay where they are
+async def catch_up_stats(channel_id):
+    channel = client.get_channel(channel_id)
+    if channel is None:
+        logger.error(f'Cant find watched channel {channel_id}, stats catch-up skipped')
+        return
+    try:
+        last_stat_update = await db.get_flag('last_stat_update', channel_id)
+        if last_stat_update:
+            settings = await get_guild_settings(channel.guild)
+            current_date = local_date(datetime.utcnow(), settings.utc_offset if settings else utc_time_offset)
+            last_stat_update_date = datetime.strptime(last_stat_update, "%Y-%m-%d").date()
+            date_difference = current_date - last_stat_update_date
+            iterdates = (last_stat_update_date + timedelta(n + 1) for n in range(date_difference.days - 1))
+            for date_to_update in iterdates:
+                await update_message_stats(date_to_update, channel_id)
+            await update_message_stats('today', channel_id)
+        else:
+            logger.info('Cant find "last_stat_update" flag. Updating usin "all" mode')
+            await update_message_stats('all', channel_id)
+    except Exception as e:
+        logger.error(f'Stats catch-up failed for channel {channel_id}: {repr(e)}')
+        return
+    stats_catching_up.discard(channel_id)
 
 # Lots of fun!
 @client.command()
@@ -706,31 +1065,40 @@ async def slap(ctx, target):
     await ctx.send(f'{ctx.author.mention} slaps {target} around a bit with a large trout')
 
 # Check for birthdays and congratulate member
-async def report_birthdays():
-    await client.wait_until_ready()
-    db = AsyncDB(db_path, db_init_script)
-    while not client.is_closed():
-        for watched_channel in discord_watched_channels:
-            channel = client.get_channel(watched_channel)
-            birthdays = await db.get_birthdays()
-            current_str_time = time.gmtime(time.time())
-            if current_str_time[3] >= birthday_report_time:
-                for birthday in birthdays:
-                    user_id = birthday[0]
-                    date = convert_to_structdate(birthday[1])
-                    last_reported = birthday[2]
-                    if not date:
-                        continue
-                    if last_reported == datetime.now().year:
-                        continue
-                    if date[1:3] == current_str_time[1:3]:
-                        await congrat(channel, user_id)
-                        await db.mark_congrated(user_id, datetime.now().year)
-        await asyncio.sleep(check_frequency)
+# Congratulations are scheduled per guild, each scheduler task sleeps until the next birthday is due
+async def load_birthday_schedulers():
+    scheduled = 0
+    for settings in await db.get_guilds():
+        scheduled += await load_birthday_scheduler(settings)
+    logger.info(f'Scheduled {scheduled} birthdays')
+
+
+# (Re)load the guild's birthdays, the scheduler task is started on the first load
+async def load_birthday_scheduler(settings):
+    scheduler = birthday_schedulers.get(settings.id)
+    if scheduler is None:
+        scheduler = birthday_schedulers[settings.id] = BirthdayScheduler(birthday_report_time, settings.utc_offset)
+        birthday_tasks[settings.id] = client.loop.create_task(scheduler.run(partial(congrat_member, settings.id)))
+    else:
+        scheduler.utc_offset = timedelta(hours=settings.utc_offset)
+    scheduler.load(await db.get_birthdays(settings.id))
+    return len(scheduler.entries)
+
+
+# Congratulate in the guild's congratulations channel (the first watched one if it is not set)
+# and mark the year as reported
+async def congrat_member(guild_id, user_id, year):
+    settings = await db.get_guild(guild_id)
+    channel_id = settings.congrats_channel or min(settings.watched_channels, default=None)
+    channel = client.get_channel(channel_id)
+    if channel is None:
+        raise UserWarning(f'No channel for congratulations in guild {guild_id}')
+    await congrat(channel, user_id)
+    await db.mark_congrated(guild_id, user_id, year)
 
 
 async def congrat(channel, user_id):
-    congrats = [i[0] for i in await db.get_congrats()]
+    congrats = await db.get_congrats()
     message = random.choice(congrats)
     user_name = get_user_mention(channel, user_id)
     await channel.send(message.format(user_name=user_name))
@@ -741,6 +1109,10 @@ async def congrat(channel, user_id):
 async def set_birthday(ctx):
     logger.info('Got set_birthday command')
 
+    settings = await get_guild_settings(ctx.guild)
+    if settings is None:
+        logger.error('set_birthday command outside of a configured guild')
+        return
     try:
         target_user_id = ctx.message.mentions[0].id
     except:
@@ -748,36 +1120,28 @@ async def set_birthday(ctx):
         return
     message = ctx.message.clean_content.split(' ')
     date_raw = message[-1]
-    if not convert_to_structdate(date_raw):
+    if not parse_birthday(date_raw):
+        logger.error('No date or wrong date format')
         return
 
-    members = await db.get_members()
-    if target_user_id not in members:
-        await db.add_member(target_user_id)
+    if not await db.has_member(settings.id, target_user_id):
+        await db.add_member(settings.id, target_user_id)
+        await sync_member_name(ctx.message.mentions[0])
         report_text = f'Added birthday date for {ctx.message.mentions[0].display_name}'
     else:
         report_text = f'Updated birthday date for {ctx.message.mentions[0].display_name}'
-    await db.update_birthday(target_user_id, date_raw)
+    await db.update_birthday(settings.id, target_user_id, date_raw)
+    if settings.id in birthday_schedulers:
+        birthday_schedulers[settings.id].set(target_user_id, date_raw)
+    else:
+        await load_birthday_scheduler(settings)
+    render_cache.invalidate(command='show_birthdays')
     logger.info(report_text)
     await ctx.send(report_text)
 
 
-def convert_to_structdate(date_raw):
-    try:
-        if len(date_raw.split('.')) == 3:
-            frmt = '%d.%m.%Y'
-        else:
-            frmt = '%d.%m'
-        return time.strptime(date_raw, frmt)
-    except:
-        logger.error('No date or wrong date format')
-        return
-
-
 def get_user_mention(channel, user_id):
-    for user in channel.members:
-        if user.id == user_id:
-            return user.mention
+    return guild_cache.mention(channel.guild.id, user_id)
 
 
 # Send report on stored birthdays sorted by user name
@@ -794,15 +1158,20 @@ async def show_birthdays(ctx, *, args=''):
         await ctx.send(e)
         return
 
+    guild_id = ctx.guild.id if ctx.guild else None
+    cache_key = ('show_birthdays', None, guild_id, None, args.sort)
+    cached = render_cache.get(cache_key)
+    if cached is not None:
+        await ctx.send(cached)
+        return
+
     # Get the list of current members with birthdays from the database
-    birthdays = await db.get_birthdays()
-    members_list = [[member.id, member.display_name] for member in ctx.channel.members]
-    members_id = [member.id for member in ctx.channel.members]
-    members_dict = {i[0]: i[1] for i in members_list}
+    birthdays = await db.get_birthdays(guild_id)
+    members = guild_cache.members(guild_id)
     eligible_birthdays = []
     for birthday in birthdays:
-        if birthday[0] in members_id:
-            eligible_birthdays.append([members_dict[birthday[0]], birthday[1]])
+        if birthday[0] in members:
+            eligible_birthdays.append([members[birthday[0]][0], birthday[1]])
     if not eligible_birthdays:
         logger.debug('No eligible birthdays found for reply')
         return
@@ -811,7 +1180,7 @@ async def show_birthdays(ctx, *, args=''):
     if args.sort == 'name':
         eligible_birthdays.sort(key=lambda x: x[0].lower())
     elif args.sort == 'date':
-        eligible_birthdays.sort(key=lambda x: convert_to_structdate(x[1]))
+        eligible_birthdays.sort(key=lambda x: (parse_birthday(x[1]) or (0, 0))[::-1])
     else:
         logging.error('Unsupported sorting method')
         return
@@ -824,25 +1193,52 @@ async def show_birthdays(ctx, *, args=''):
         reply.append(f'- {birthday[0]}{spaces*" "}{birthday[1]}')
     reply.append('```')
     reply_string = '\n'.join(reply)
+    render_cache.set(cache_key, reply_string)
     await ctx.send(reply_string)
 
-# Update memeber names once a day
+# Stored member names are the user names, the same as fetch_user().display_name
+# Write the name of a registered member if it changed, from gateway events, no REST calls
+async def sync_member_name(user):
+    if await db.has_user(user.id) and await db.get_member_name(user.id) != user.name:
+        await db.update_names_bulk([(user.name, user.id)])
+
+
+# Reconcile member names once a day, events may be missed while the bot is offline. Users known to the
+# client are compared locally, only the ones missing from its cache are fetched
 async def update_member_names():
     await client.wait_until_ready()
-    db = AsyncDB(db_path, db_init_script)
     while not client.is_closed():
-        members = await db.get_members()
-        for member_id in members:
-            try:
-                member = await client.fetch_user(member_id)
-                await db.update_name(member_id, member.display_name)
-            except:
-                # For dead bots in the chat...
-                pass
-        logger.info('Daily update of member names completed')
-
+        await reconcile_member_names()
         await asyncio.sleep(check_frequency*24)
 
+
+async def reconcile_member_names():
+    member_names = await db.get_member_names()
+    changed = {}
+    missing = []
+    for member_id, name in member_names.items():
+        user = client.get_user(member_id)
+        if user is None:
+            missing.append(member_id)
+        elif user.name != name:
+            changed[member_id] = user.name
+
+    async def fetch_user(member_id):
+        try:
+            return await client.fetch_user(member_id)
+        except Exception as e:
+            # For dead bots in the chat...
+            logger.debug(f'Cant fetch user {member_id}: {repr(e)}')
+
+    fetched = await gather_bounded(fetch_user, missing, name_sync_concurrency)
+    for member_id, user in zip(missing, fetched):
+        if user is not None and user.name != member_names[member_id]:
+            changed[member_id] = user.name
+
+    if changed:
+        await db.update_names_bulk([(name, member_id) for member_id, name in changed.items()])
+    logger.info(f'Member names reconciled: {len(changed)} changed, {len(missing)} fetched')
+
 @client.command()
 async def update_titles(ctx):
     await update_video_titles()
@@ -858,11 +1254,125 @@ async def get_tags(ctx):
     await get_tags_lastfm()
     await ctx.send(ok_reply)
 
+# Full enrichment run: titles, then artists, then tags
+@client.command()
+async def enrich(ctx):
+    logger.info('Got enrich command')
+    await update_video_titles()
+    await guess_artist()
+    await get_tags_lastfm()
+    await ctx.send(ok_reply)
+
+# Reload members, congratulation texts and flags after the database was edited by hand
+@client.command()
+async def reload_data(ctx):
+    logger.info('Got reload_data command')
+    if ctx.author.id not in bot_admins:
+        logger.info(f'{ctx.author.id} is not an admin, rejected reload_data command')
+        return
+    db.invalidate_reference()
+    await load_birthday_schedulers()
+    render_cache.clear()
+    await ctx.send(ok_reply)
+
+
+# Show or change the server settings: archive channel, watched channels, congratulations channel, duplicate
+# emoji and timezone. History of newly watched channels is scanned for stats in the background
+@client.command()
+async def configure(ctx, *, args=''):
+    logger.info('Got configure command')
+    if ctx.guild is None:
+        return
+    if not is_guild_admin(ctx):
+        logger.info(f'{ctx.author.id} is not an admin, rejected configure command')
+        return
+
+    parser = ArgumentParser()
+    parser.add_argument('-a', '--archive', type=int, default=None)
+    parser.add_argument('-w', '--watch', type=int, nargs='+', default=[])
+    parser.add_argument('-u', '--unwatch', type=int, nargs='+', default=[])
+    parser.add_argument('-b', '--birthdays', type=int, default=None)
+    parser.add_argument('-e', '--emoji', default=None)
+    parser.add_argument('-t', '--timezone', type=int, default=None)
+    try:
+        args = parser.parse_args(args.split())
+    except ParsingError as e:
+        logger.error(f'Unable to parse args for configure command: {e}')
+        await ctx.send(e)
+        return
+
+    for channel_id in args.watch + args.unwatch + [args.archive, args.birthdays]:
+        if channel_id is not None and ctx.guild.get_channel(channel_id) is None:
+            await ctx.send(f'Cant find channel {channel_id} on this server')
+            return
+
+    stored = await db.get_guild(ctx.guild.id)
+    current = stored or GuildSettings(ctx.guild.id, None, None, duplicate_emoji, utc_time_offset, frozenset())
+    changes = {'archive_channel': args.archive, 'congrats_channel': args.birthdays,
+               'duplicate_emoji': args.emoji, 'utc_offset': args.timezone}
+    settings = current._replace(**{field: value for field, value in changes.items() if value is not None})
+    if settings != stored:
+        await db.set_guild(settings.id, settings.archive_channel, settings.congrats_channel,
+                           settings.duplicate_emoji, settings.utc_offset)
+    for channel_id in args.unwatch:
+        await db.unwatch_channel(settings.id, channel_id)
+    new_channels = [channel_id for channel_id in args.watch if channel_id not in settings.watched_channels]
+    for channel_id in new_channels:
+        await db.watch_channel(settings.id, channel_id)
+        client.loop.create_task(update_message_stats('all', channel_id))
+
+    settings = await db.get_guild(settings.id)
+    await load_birthday_scheduler(settings)
+    render_cache.clear()
+    logger.info(f'Guild {settings.id} configured: {settings}')
+    await ctx.send(f'Archive channel: <#{settings.archive_channel}>\n'
+                   f'Watched channels: {" ".join(f"<#{channel}>" for channel in sorted(settings.watched_channels)) or "none"}\n'
+                   f'Congratulations channel: {f"<#{settings.congrats_channel}>" if settings.congrats_channel else "first watched"}\n'
+                   f'Duplicate emoji: {settings.duplicate_emoji}\n'
+                   f'UTC offset: {settings.utc_offset}')
+
+
+# Show the slowest operations: commands, database queries, last.fm and youtube calls
+@client.command()
+async def perf(ctx, *, args=''):
+    logger.info('Got perf command')
+    if ctx.author.id not in bot_admins:
+        logger.info(f'{ctx.author.id} is not an admin, rejected perf command')
+        return
+
+    parser = ArgumentParser()
+    parser.add_argument('-n', '--number', type=int, default=10)
+    parser.add_argument('-r', '--reset', action='store_true')
+    try:
+        args = parser.parse_args(args.split())
+    except ParsingError as e:
+        logger.error(f'Unable to parse args for perf command: {e}')
+        await ctx.send(e)
+        return
+
+    if args.reset:
+        METRICS.clear()
+        await ctx.send(ok_reply)
+        return
+
+    # Keep the table within a single discord message
+    slowest = METRICS.top(min(args.number, 20))
+    if not slowest:
+        await ctx.send('No operations recorded yet')
+        return
+    lines = [f"{'operation':<36}{'calls':>8}{'errors':>8}{'mean ms':>10}{'p95 ms':>10}{'max ms':>10}"]
+    for kind, name, histogram in slowest:
+        lines.append(f'{kind + "." + name:<36}{histogram.count:>8}{histogram.errors:>8}'
+                     f'{histogram.mean * 1000:>10.1f}{histogram.quantile(0.95) * 1000:>10.1f}{histogram.max * 1000:>10.1f}')
+    await ctx.send('```' + '\n'.join(lines) + '```')
+
 # WRYYYYY
-try:
-    client.loop.create_task(report_birthdays())
-    client.loop.create_task(update_stats_daily())
-    client.loop.create_task(update_member_names())
-    client.run(discord_token)
-except:
-    logger.error('Failed to init discord bot')
+if __name__ == '__main__':
+    try:
+        if metrics_port:
+            client.loop.create_task(metrics_server.start())
+        client.loop.create_task(update_stats_daily())
+        client.loop.create_task(update_member_names())
+        client.run(discord_token)
+    except:
+        logger.error('Failed to init discord bot')
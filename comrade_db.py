@@ -1,29 +1,232 @@
+from collections import namedtuple
+from contextlib import asynccontextmanager
+from datetime import date, timedelta
+import asyncio
 import aiosqlite
 import sqlite3
 import os
 import logging
 
+from metrics import instrumented
+
+
+# Connection pragmas applied to every pooled connection, overridable from config
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -16000,
+    'mmap_size': 134217728,
+    'busy_timeout': 5000,
+}
+
 
 class DatabaseError(Exception):
     def __init__(self, message):
         self.message = message
 
 
+# SQLite default limit of host parameters per statement is 999
+MAX_VARIABLES = 900
+
+
+# Single writer: every write is queued and executed by one task on the writer connection.
+# Queued writes are grouped into one transaction, committed when max_batch writes are collected or
+# max_delay seconds have passed (with no delay, the group is whatever queued up during the previous commit).
+# Each write runs in its own savepoint, so a failing one doesn't take the rest of the group down.
+# Callers get the lastrowid (or the rows, if the last statement is a query) once the group is committed
+class DBWriter:
+    def __init__(self, connection, max_batch=200, max_delay=0):
+        self.logger = logging.getLogger("comrade")
+        self.connection = connection
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = asyncio.Queue()
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.ensure_future(self._run())
+
+    # Commit everything queued so far and stop
+    async def stop(self):
+        if self.task is None:
+            return
+        await self.queue.put(None)
+        await self.task
+        self.task = None
+
+    # statements: list of (sql, params, many), executed atomically. Exclusive writes run outside of
+    # a transaction, alone (eg. VACUUM)
+    async def submit(self, statements, exclusive=False):
+        if self.task is None:
+            raise DatabaseError('Database writer is not running')
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((statements, exclusive, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        stopping = False
+        while not stopping:
+            item = await self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch and not batch[-1][1]:
+                try:
+                    item = self.queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            # Exclusive writes can only be the last in a batch, run them after the group commit
+            exclusive = batch.pop() if batch[-1][1] else None
+            if batch:
+                await self._commit_group(batch)
+            if exclusive:
+                await self._run_exclusive(exclusive)
+
+    async def _execute(self, statements):
+        cur = None
+        for sql, params, many in statements:
+            if many:
+                cur = await self.connection.executemany(sql, params)
+            else:
+                cur = await self.connection.execute(sql, params)
+        if cur is None:
+            return None
+        if cur.description is not None:
+            return await cur.fetchall()
+        return cur.lastrowid
+
+    async def _commit_group(self, batch):
+        results = []
+        try:
+            await self.connection.execute('BEGIN')
+            for statements, exclusive, future in batch:
+                await self.connection.execute('SAVEPOINT write')
+                try:
+                    results.append((future, await self._execute(statements), None))
+                    await self.connection.execute('RELEASE write')
+                except sqlite3.Error as e:
+                    await self.connection.execute('ROLLBACK TO write')
+                    await self.connection.execute('RELEASE write')
+                    results.append((future, None, e))
+            await self.connection.execute('COMMIT')
+        except Exception as e:
+            self.logger.error(f'Database group commit of {len(batch)} writes failed: {repr(e)}')
+            try:
+                await self.connection.execute('ROLLBACK')
+            except sqlite3.Error:
+                pass
+            results = [(future, None, e) for statements, exclusive, future in batch]
+
+        for future, result, error in results:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    async def _run_exclusive(self, item):
+        statements, exclusive, future = item
+        try:
+            result = await self._execute(statements)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(result)
+
+
+# Small persistent pool: the writer connection (owned by the DBWriter task) and a reader connection.
+# With WAL journaling readers don't block on the writer
 class DBConnection:
-    def __init__(self, db_path, init_script):
+    def __init__(self, db_path, init_script, pragmas=None, cached_statements=128, write_batch=200, write_delay=0):
         self.logger = logging.getLogger("comrade")
         self.db_path = db_path
         self.init_script = init_script
+        self.pragmas = dict(DEFAULT_PRAGMAS)
+        if pragmas:
+            self.pragmas.update(pragmas)
+        self.cached_statements = cached_statements
+        self.write_batch = write_batch
+        self.write_delay = write_delay
+        self.writer = None
+        self.reader = None
+        self._connect_lock = asyncio.Lock()
+        self._read_lock = asyncio.Lock()
         if not os.path.isfile(self.db_path):
             self.logger.error('Cant find database file. Creating the new one')
             self._create_db()
+        self._migrate()
+
+    # Reads share the reader connection, one block at a time. aiosqlite steps and fetches in separate calls,
+    # a statement another read left unfinished would keep the connection's snapshot and hide newer commits
+    @asynccontextmanager
+    async def read(self):
+        if self.reader is None:
+            await self.connect()
+        async with self._read_lock:
+            yield self.reader
+
+    # Writes, all go through the writer task. Return lastrowid of the (last) statement, rows if it is a query
+    async def write(self, sql, params=()):
+        return await self.write_transaction([(sql, params, False)])
+
+    async def write_many(self, sql, seq_of_params):
+        return await self.write_transaction([(sql, list(seq_of_params), True)])
+
+    async def write_transaction(self, statements):
+        if self.writer is None:
+            await self.connect()
+        return await self.writer.submit(statements)
+
+    async def write_exclusive(self, sql, params=()):
+        if self.writer is None:
+            await self.connect()
+        return await self.writer.submit([(sql, params, False)], exclusive=True)
 
-    async def __aenter__(self):
-        self.db = await aiosqlite.connect(self.db_path)
-        return self.db
+    # Open the pooled connections once, all later calls are no-op
+    async def connect(self):
+        async with self._connect_lock:
+            if self.writer is not None:
+                return
+            self.writer = DBWriter(await self._open(isolation_level=None), self.write_batch, self.write_delay)
+            self.writer.start()
+            self.reader = await self._open()
+            self.logger.info(f'Database connections opened: {self.pragmas}')
 
-    async def __aexit__(self, exc_type, exc, tb):
-        await self.db.close()
+    # Flush pending writes and close
+    async def close(self):
+        async with self._connect_lock:
+            if self.writer is not None:
+                await self.writer.stop()
+                await self.writer.connection.close()
+            if self.reader is not None:
+                await self.reader.close()
+            self.reader = None
+            self.writer = None
+            self.logger.info('Database connections closed')
+
+    async def _open(self, **kwargs):
+        connection = await aiosqlite.connect(self.db_path, cached_statements=self.cached_statements, **kwargs)
+        for pragma, value in self.pragmas.items():
+            if value is None:
+                continue
+            await connection.execute(f'PRAGMA {pragma} = {value}')
+        return connection
 
     def _create_db(self):
         connection = sqlite3.connect(self.db_path)
@@ -38,116 +241,733 @@ class DBConnection:
         connection.close()
         self.logger.info('New database created')
 
+    # Bring the schema up to date. PRAGMA user_version holds the number of applied migrations
+    def _migrate(self):
+        connection = sqlite3.connect(self.db_path, isolation_level=None)
+        try:
+            version = connection.execute('PRAGMA user_version').fetchone()[0]
+            for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+                connection.execute('BEGIN')
+                try:
+                    migration(connection)
+                    connection.execute(f'PRAGMA user_version = {number}')
+                    connection.execute('COMMIT')
+                except:
+                    connection.execute('ROLLBACK')
+                    self.logger.error(f'Database migration {number} failed')
+                    raise
+                self.logger.info(f'Applied database migration {number}: {migration.__name__}')
+        finally:
+            connection.close()
+
+
+def _add_column(connection, table, column, column_type):
+    columns = [row[1] for row in connection.execute(f'PRAGMA table_info({table})')]
+    if column not in columns:
+        connection.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+
+
+# Tables and columns the bot uses but older databases (and the old init script) lack
+def _migration_base_schema(connection):
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS Tags (
+            video_id INTEGER NOT NULL,
+            tag TEXT NOT NULL,
+            FOREIGN KEY(video_id) REFERENCES Videos(id)
+        );
+    """)
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS Statistics (
+            channel_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            post_count INTEGER NOT NULL
+        );
+    """)
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS Flags (
+            flag_name TEXT NOT NULL,
+            channel_id INTEGER NOT NULL,
+            flag_value TEXT
+        );
+    """)
+    _add_column(connection, 'Videos', 'video_title', 'TEXT')
+    _add_column(connection, 'Members', 'name', 'TEXT')
+
+
+# Unique key for daily stats, required by the bulk upsert
+def _migration_statistics_key(connection):
+    connection.execute("""
+        DELETE FROM Statistics
+        WHERE rowid NOT IN (
+            SELECT MIN(rowid)
+            FROM Statistics
+            GROUP BY channel_id, date, user_id
+        );
+    """)
+    connection.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS Statistics_channel_date_user
+        ON Statistics(channel_id, date, user_id);
+    """)
+
+
+# Indexes for the archive dedupe path (link lookups and posted checks) and tag lookups
+def _migration_archive_indexes(connection):
+    # Merge duplicate links into the oldest video row before making the link unique
+    connection.execute("""
+        CREATE TEMP TABLE VideoDuplicates AS
+        SELECT V.id AS duplicate_id, K.keep_id
+        FROM Videos V
+        JOIN (SELECT link, MIN(id) AS keep_id FROM Videos GROUP BY link) K ON V.link = K.link
+        WHERE V.id != K.keep_id;
+    """)
+    for table in ('Posted', 'Tags'):
+        connection.execute(f"""
+            UPDATE {table}
+            SET video_id = (SELECT keep_id FROM VideoDuplicates WHERE duplicate_id = {table}.video_id)
+            WHERE video_id IN (SELECT duplicate_id FROM VideoDuplicates);
+        """)
+    connection.execute("""
+        DELETE FROM Videos
+        WHERE id IN (SELECT duplicate_id FROM VideoDuplicates);
+    """)
+    connection.execute("DROP TABLE VideoDuplicates")
+
+    connection.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS Videos_link
+        ON Videos(link);
+    """)
+    connection.execute("""
+        CREATE INDEX IF NOT EXISTS Posted_archive_channel_video
+        ON Posted(archive_channel, video_id);
+    """)
+    connection.execute("""
+        CREATE INDEX IF NOT EXISTS Tags_video
+        ON Tags(video_id);
+    """)
+
+
+# Cached last.fm artist lookups, tags are stored as json
+def _migration_lastfm_cache(connection):
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS LastfmArtists (
+            artist TEXT NOT NULL PRIMARY KEY,
+            tags TEXT,
+            found INTEGER NOT NULL,
+            fetched_at INTEGER NOT NULL
+        );
+    """)
+
+
+# Cached youtube video metadata, unavailable = deleted or private
+def _migration_youtube_cache(connection):
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS YoutubeVideos (
+            video_id TEXT NOT NULL PRIMARY KEY,
+            title TEXT,
+            category TEXT,
+            unavailable INTEGER NOT NULL,
+            fetched_at INTEGER NOT NULL
+        );
+    """)
+
+
+# Rollup buckets kept for every stats source: (period, bucket expression over a date)
+ROLLUP_PERIODS = (
+    ('week', "date({date}, 'weekday 0', '-6 days')"),
+    ('month', "date({date}, 'start of month')"),
+    ('total', "''"),
+)
+
+# Stats sources: kind -> (table, channel column, date expression, count expression, periods).
+# {row} is 'NEW.'/'OLD.' inside triggers and empty otherwise. Message stats use Statistics rows
+# for single days, archive rollups keep days too
+ROLLUP_SOURCES = {
+    'messages': ('Statistics', 'channel_id', '{row}date', '{row}post_count', ROLLUP_PERIODS),
+    'archive': ('Posted', 'archive_channel', 'date({row}date_posted)', '1', (('day', '{date}'),) + ROLLUP_PERIODS),
+}
+
+
+def _rollup_statements(kind, row, sign):
+    table, channel, date_expr, count_expr, periods = ROLLUP_SOURCES[kind]
+    date_expr = date_expr.format(row=row + '.')
+    count_expr = count_expr.format(row=row + '.')
+    statements = []
+    for period, bucket in periods:
+        bucket = bucket.format(date=date_expr)
+        key = f"kind = '{kind}' AND channel_id = {row}.{channel} AND period = '{period}' AND bucket = {bucket} AND user_id = {row}.user_id"
+        statements.append(f"""
+            INSERT INTO Rollups(kind, channel_id, period, bucket, user_id, post_count)
+            SELECT '{kind}', {row}.{channel}, '{period}', {bucket}, {row}.user_id, 0
+            WHERE NOT EXISTS (SELECT 1 FROM Rollups WHERE {key});
+            UPDATE Rollups SET post_count = post_count {sign} {count_expr}
+            WHERE {key};
+        """)
+    return ''.join(statements)
+
+
+def _span_statements(kind, row):
+    table, channel, date_expr, count_expr, periods = ROLLUP_SOURCES[kind]
+    date_expr = date_expr.format(row=row + '.')
+    # Trigger statements can't rely on their own conflict clauses (the outer upsert overrides them)
+    return f"""
+        INSERT INTO ChannelSpans(kind, channel_id, first_date, last_date)
+        SELECT '{kind}', {row}.{channel}, {date_expr}, {date_expr}
+        WHERE NOT EXISTS (SELECT 1 FROM ChannelSpans WHERE kind = '{kind}' AND channel_id = {row}.{channel});
+        UPDATE ChannelSpans SET first_date = min(first_date, {date_expr}), last_date = max(last_date, {date_expr})
+        WHERE kind = '{kind}' AND channel_id = {row}.{channel};
+    """
+
 
+# Weekly/monthly/all-time rollups and per-channel date spans for reports, kept current by triggers
+def _migration_rollups(connection):
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS Rollups (
+            kind TEXT NOT NULL,
+            channel_id INTEGER NOT NULL,
+            period TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            post_count INTEGER NOT NULL,
+            PRIMARY KEY(kind, channel_id, period, bucket, user_id)
+        ) WITHOUT ROWID;
+    """)
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS ChannelSpans (
+            kind TEXT NOT NULL,
+            channel_id INTEGER NOT NULL,
+            first_date TEXT NOT NULL,
+            last_date TEXT NOT NULL,
+            PRIMARY KEY(kind, channel_id)
+        ) WITHOUT ROWID;
+    """)
+
+    for kind, (table, channel, date_expr, count_expr, periods) in ROLLUP_SOURCES.items():
+        # Backfill from existing rows
+        date_expr = date_expr.format(row='')
+        count_expr = count_expr.format(row='')
+        for period, bucket in periods:
+            bucket = bucket.format(date=date_expr)
+            connection.execute(f"""
+                INSERT INTO Rollups(kind, channel_id, period, bucket, user_id, post_count)
+                SELECT '{kind}', {channel}, '{period}', {bucket}, user_id, SUM({count_expr})
+                FROM {table}
+                GROUP BY {channel}, {bucket}, user_id;
+            """)
+        connection.execute(f"""
+            INSERT INTO ChannelSpans(kind, channel_id, first_date, last_date)
+            SELECT '{kind}', {channel}, MIN({date_expr}), MAX({date_expr})
+            FROM {table}
+            GROUP BY {channel};
+        """)
+
+        # Keep rollups current
+        connection.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_rollup_insert AFTER INSERT ON {table}
+            BEGIN
+                {_rollup_statements(kind, 'NEW', '+')}
+                {_span_statements(kind, 'NEW')}
+            END;
+        """)
+        connection.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_rollup_delete AFTER DELETE ON {table}
+            BEGIN
+                {_rollup_statements(kind, 'OLD', '-')}
+            END;
+        """)
+    connection.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS Statistics_rollup_update AFTER UPDATE OF post_count ON Statistics
+        BEGIN
+            {_rollup_statements('messages', 'OLD', '-')}
+            {_rollup_statements('messages', 'NEW', '+')}
+        END;
+    """)
+
+
+# Unique key for flags, required by the upsert in set_flag. The latest duplicate wins
+def _migration_flags_key(connection):
+    connection.execute("""
+        DELETE FROM Flags
+        WHERE rowid NOT IN (
+            SELECT MAX(rowid)
+            FROM Flags
+            GROUP BY flag_name, channel_id
+        );
+    """)
+    connection.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS Flags_name_channel
+        ON Flags(flag_name, channel_id);
+    """)
+
+
+# Per-guild settings and watched channels, members partitioned by guild. Channel scoped tables (Statistics,
+# Posted, Flags, rollups) are partitioned already: channel ids are unique across guilds. Existing members
+# get guild_id 0 until the guild from the legacy config adopts them
+def _migration_guilds(connection):
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS Guilds (
+            id INTEGER NOT NULL PRIMARY KEY,
+            archive_channel INTEGER,
+            congrats_channel INTEGER,
+            duplicate_emoji TEXT,
+            utc_offset INTEGER NOT NULL DEFAULT 0
+        );
+    """)
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS Channels (
+            id INTEGER NOT NULL UNIQUE,
+            is_watched TEXT NOT NULL,
+            PRIMARY KEY(id)
+        );
+    """)
+    _add_column(connection, 'Channels', 'guild_id', 'INTEGER NOT NULL DEFAULT 0')
+    connection.execute("""
+        CREATE INDEX IF NOT EXISTS Channels_guild
+        ON Channels(guild_id);
+    """)
+
+    # The primary key changes, SQLite needs the table rebuilt
+    connection.execute("""
+        CREATE TABLE GuildMembers (
+            guild_id INTEGER NOT NULL,
+            id INTEGER NOT NULL,
+            birthday TEXT,
+            last_reported INTEGER,
+            name TEXT,
+            PRIMARY KEY(guild_id, id)
+        );
+    """)
+    connection.execute("""
+        INSERT INTO GuildMembers(guild_id, id, birthday, last_reported, name)
+        SELECT 0, id, birthday, last_reported, name
+        FROM Members;
+    """)
+    connection.execute("DROP TABLE Members")
+    connection.execute("ALTER TABLE GuildMembers RENAME TO Members")
+
+
+# Remaining dates of a channel, in {order}: read when a row at the edge of the channel's span is deleted.
+# Archive days come from the daily rollups, which the delete trigger has already decremented
+SPAN_DATES = {
+    'messages': "SELECT date FROM Statistics WHERE channel_id = {channel} ORDER BY date {order} LIMIT 1",
+    'archive': "SELECT bucket FROM Rollups WHERE kind = 'archive' AND channel_id = {channel} AND period = 'day' "
+               "AND post_count > 0 ORDER BY bucket {order} LIMIT 1",
+}
+
+
+def _span_delete_statements(kind, row):
+    table, channel, date_expr, count_expr, periods = ROLLUP_SOURCES[kind]
+    date_expr = date_expr.format(row=row + '.')
+    first_date = SPAN_DATES[kind].format(channel=f'{row}.{channel}', order='ASC')
+    last_date = SPAN_DATES[kind].format(channel=f'{row}.{channel}', order='DESC')
+    key = f"kind = '{kind}' AND channel_id = {row}.{channel} AND (first_date = {date_expr} OR last_date = {date_expr})"
+    return f"""
+        DELETE FROM ChannelSpans
+        WHERE {key} AND ({first_date}) IS NULL;
+        UPDATE ChannelSpans SET first_date = ({first_date}), last_date = ({last_date})
+        WHERE {key};
+    """
+
+
+# Spans shrink when their first or last rows are deleted (archive wipes, day rescans). Existing spans are rebuilt
+def _migration_span_deletes(connection):
+    connection.execute("DELETE FROM ChannelSpans")
+    for kind, (table, channel, date_expr, count_expr, periods) in ROLLUP_SOURCES.items():
+        date_expr = date_expr.format(row='')
+        connection.execute(f"""
+            INSERT INTO ChannelSpans(kind, channel_id, first_date, last_date)
+            SELECT '{kind}', {channel}, MIN({date_expr}), MAX({date_expr})
+            FROM {table}
+            GROUP BY {channel};
+        """)
+        connection.execute(f"DROP TRIGGER IF EXISTS {table}_rollup_delete")
+        connection.execute(f"""
+            CREATE TRIGGER {table}_rollup_delete AFTER DELETE ON {table}
+            BEGIN
+                {_rollup_statements(kind, 'OLD', '-')}
+                {_span_delete_statements(kind, 'OLD')}
+            END;
+        """)
+
+
+# Applied in order, never edit or reorder released migrations - append new ones
+MIGRATIONS = [
+    _migration_base_schema,
+    _migration_statistics_key,
+    _migration_archive_indexes,
+    _migration_lastfm_cache,
+    _migration_youtube_cache,
+    _migration_rollups,
+    _migration_flags_key,
+    _migration_guilds,
+    _migration_span_deletes,
+]
+
+# Guild of the members which were stored before the migration to guilds
+LEGACY_GUILD = 0
+
+
+MemberRecord = namedtuple('MemberRecord', ['birthday', 'last_reported', 'name'])
+
+# Guild configuration, watched_channels is a frozenset of channel ids
+GuildSettings = namedtuple('GuildSettings', ['id', 'archive_channel', 'congrats_channel', 'duplicate_emoji',
+                                             'utc_offset', 'watched_channels'])
+
+
+# In-memory copy of the reference tables
+class ReferenceData:
+    def __init__(self, members, congrats, flags, guilds):
+        # {guild_id: {member_id: MemberRecord}}
+        self.members = members
+        # [text, ...]
+        self.congrats = congrats
+        # {(flag_name, channel_id): flag_value}
+        self.flags = flags
+        # {guild_id: GuildSettings}
+        self.guilds = guilds
+
+    def guild_members(self, guild_id):
+        return self.members.setdefault(guild_id, {})
+
+    def update_member(self, guild_id, member_id, **fields):
+        members = self.members.get(guild_id, {})
+        if member_id in members:
+            members[member_id] = members[member_id]._replace(**fields)
+
+    # Names belong to the user, the same in every guild
+    def update_name(self, member_id, name):
+        for guild_id in self.members:
+            self.update_member(guild_id, member_id, name=name)
+
+
+# Split [date_from, date_to] into whole months, whole weeks (Monday based) and the leftover days.
+# Weeks are not allowed to eat into a month which could be taken whole
+def _split_range(date_from, date_to):
+    periods = {'month': [], 'week': [], 'day': []}
+    cursor = date_from
+    while cursor <= date_to:
+        next_month = (cursor.replace(day=1) + timedelta(days=32)).replace(day=1)
+        if cursor.day == 1 and next_month - timedelta(days=1) <= date_to:
+            periods['month'].append(cursor.isoformat())
+            cursor = next_month
+            continue
+        week_end = cursor + timedelta(days=6)
+        month_after = (next_month + timedelta(days=32)).replace(day=1)
+        crosses_whole_month = week_end >= next_month and month_after - timedelta(days=1) <= date_to
+        if cursor.weekday() == 0 and week_end <= date_to and not crosses_whole_month:
+            periods['week'].append(cursor.isoformat())
+            cursor = week_end + timedelta(days=1)
+            continue
+        periods['day'].append(cursor.isoformat())
+        cursor += timedelta(days=1)
+    return periods
+
+
+@instrumented('db')
 class AsyncDB:
-    def __init__(self, db_path, init_script):
+    def __init__(self, db_path, init_script, pragmas=None, cached_statements=128, write_batch=200, write_delay=0):
         self.logger = logging.getLogger("comrade")
-        self.database = DBConnection(db_path, init_script)
-
-    async def add_member(self, member_id):
-        async with self.database as db:
-            await db.execute("""
-                INSERT INTO Members (id, birthday)
-                VALUES (?, NULL);
-            """, (member_id,))
-            await db.commit()
-
-    async def get_members(self):
-        async with self.database as db:
+        self.database = DBConnection(db_path, init_script, pragmas, cached_statements, write_batch, write_delay)
+        self.reference = None
+        self._reference_lock = asyncio.Lock()
+        self._reference_writes = 0
+
+    async def connect(self):
+        await self.database.connect()
+        await self._reference_data()
+
+    async def close(self):
+        await self.database.close()
+
+    # Reference data (Members, Congrats, Flags, Guilds and watched Channels) is loaded once and kept in memory.
+    # Writes go to the database first and then to the cache. Changes made outside the bot need invalidate_reference()
+    async def _reference_data(self):
+        if self.reference is None:
+            async with self._reference_lock:
+                while self.reference is None:
+                    writes = self._reference_writes
+                    reference = await self._load_reference()
+                    # A write landed during the load, the snapshot may miss it
+                    if writes == self._reference_writes:
+                        self.reference = reference
+        return self.reference
+
+    async def _load_reference(self):
+        async with self.database.read() as db:
             cur = await db.execute("""
-                SELECT id
-                FROM Members
+                SELECT guild_id, id, birthday, last_reported, name
+                FROM Members;
             """)
-            result = await cur.fetchall()
-        return [i[0] for i in result]
-
-    async def update_birthday(self, member_id, birthday):
-        async with self.database as db:
-            await db.execute("""
-                UPDATE Members 
-                SET birthday = ?
-                WHERE id = ?
-            """, (birthday, member_id))
-            await db.commit()
-
-    async def update_name(self, member_id, name):
-        async with self.database as db:
-            await db.execute("""
-                UPDATE Members 
-                SET name = ?
-                WHERE id = ?
-            """, (name, member_id))
-            await db.commit()
-
-
-    async def get_birthdays(self):
-        async with self.database as db:
+            members = {}
+            for guild_id, member_id, *fields in await cur.fetchall():
+                members.setdefault(guild_id, {})[member_id] = MemberRecord(*fields)
             cur = await db.execute("""
-                SELECT id, birthday, last_reported
-                FROM Members
-                WHERE birthday is not NULL
+                SELECT text
+                FROM Congrats;
             """)
-            result = await cur.fetchall()
-        return result
+            congrats = [row[0] for row in await cur.fetchall()]
+            cur = await db.execute("""
+                SELECT flag_name, channel_id, flag_value
+                FROM Flags;
+            """)
+            flags = {(flag_name, channel_id): flag_value for flag_name, channel_id, flag_value in await cur.fetchall()}
+            cur = await db.execute("""
+                SELECT guild_id, id
+                FROM Channels
+                WHERE is_watched = '1';
+            """)
+            watched = {}
+            for guild_id, channel_id in await cur.fetchall():
+                watched.setdefault(guild_id, set()).add(channel_id)
+            cur = await db.execute("""
+                SELECT id, archive_channel, congrats_channel, duplicate_emoji, utc_offset
+                FROM Guilds;
+            """)
+            guilds = {row[0]: GuildSettings(*row, frozenset(watched.get(row[0], ()))) for row in await cur.fetchall()}
+        self.logger.debug(f'Reference data loaded: {sum(len(guild) for guild in members.values())} members, '
+                          f'{len(congrats)} congrats, {len(flags)} flags, {len(guilds)} guilds')
+        return ReferenceData(members, congrats, flags, guilds)
+
+    def _update_reference(self, update):
+        self._reference_writes += 1
+        if self.reference is not None:
+            update(self.reference)
+
+    def invalidate_reference(self):
+        self.reference = None
 
-    async def mark_congrated(self, member_id, last_reported):
-        async with self.database as db:
-            await db.execute("""
-                UPDATE Members 
-                SET last_reported = ?
-                WHERE id = ?
-            """, (last_reported, member_id))
-            await db.commit()
+    # Guild settings or None if the guild is not configured
+    async def get_guild(self, guild_id):
+        return (await self._reference_data()).guilds.get(guild_id)
 
+    async def get_guilds(self):
+        return list((await self._reference_data()).guilds.values())
+
+    # Insert or replace the settings, watched channels are kept
+    async def set_guild(self, guild_id, archive_channel, congrats_channel, duplicate_emoji, utc_offset):
+        await self.database.write("""
+            INSERT INTO Guilds(id, archive_channel, congrats_channel, duplicate_emoji, utc_offset)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET archive_channel = excluded.archive_channel,
+                congrats_channel = excluded.congrats_channel, duplicate_emoji = excluded.duplicate_emoji,
+                utc_offset = excluded.utc_offset;
+        """, (guild_id, archive_channel, congrats_channel, duplicate_emoji, utc_offset))
+
+        def update(reference):
+            current = reference.guilds.get(guild_id)
+            watched = current.watched_channels if current else frozenset()
+            reference.guilds[guild_id] = GuildSettings(guild_id, archive_channel, congrats_channel, duplicate_emoji,
+                                                       utc_offset, watched)
+        self._update_reference(update)
+
+    # Forget the settings and watched channels of a guild the bot has left. Stats and members are kept
+    async def remove_guild(self, guild_id):
+        await self.database.write_transaction([
+            ("""
+                DELETE FROM Channels
+                WHERE guild_id = ?;
+            """, (guild_id,), False),
+            ("""
+                DELETE FROM Guilds
+                WHERE id = ?;
+            """, (guild_id,), False),
+        ])
+        self._update_reference(lambda reference: reference.guilds.pop(guild_id, None))
+
+    async def watch_channel(self, guild_id, channel_id):
+        await self.database.write("""
+            INSERT INTO Channels(id, is_watched, guild_id)
+            VALUES (?, '1', ?)
+            ON CONFLICT(id) DO UPDATE SET is_watched = excluded.is_watched, guild_id = excluded.guild_id;
+        """, (channel_id, guild_id))
+        self._update_reference(lambda reference: self._set_watched(reference, guild_id, channel_id, True))
+
+    async def unwatch_channel(self, guild_id, channel_id):
+        await self.database.write("""
+            DELETE FROM Channels
+            WHERE id = ? AND guild_id = ?;
+        """, (channel_id, guild_id))
+        self._update_reference(lambda reference: self._set_watched(reference, guild_id, channel_id, False))
+
+    @staticmethod
+    def _set_watched(reference, guild_id, channel_id, watched):
+        current = reference.guilds.get(guild_id)
+        if current is None:
+            return
+        channels = current.watched_channels | {channel_id} if watched else current.watched_channels - {channel_id}
+        reference.guilds[guild_id] = current._replace(watched_channels=channels)
+
+    # Move the members stored before the migration to guilds into the guild. Members the guild already has win
+    async def adopt_legacy_members(self, guild_id):
+        await self.database.write_transaction([
+            ("""
+                UPDATE OR IGNORE Members
+                SET guild_id = ?
+                WHERE guild_id = ?;
+            """, (guild_id, LEGACY_GUILD), False),
+            ("""
+                DELETE FROM Members
+                WHERE guild_id = ?;
+            """, (LEGACY_GUILD,), False),
+        ])
+
+        def update(reference):
+            legacy = reference.members.pop(LEGACY_GUILD, {})
+            members = reference.guild_members(guild_id)
+            for member_id, member in legacy.items():
+                members.setdefault(member_id, member)
+        self._update_reference(update)
+
+    async def add_member(self, guild_id, member_id):
+        await self.database.write("""
+            INSERT INTO Members (guild_id, id, birthday)
+            VALUES (?, ?, NULL);
+        """, (guild_id, member_id))
+        self._update_reference(lambda reference: reference.guild_members(guild_id).setdefault(member_id, MemberRecord(None, None, None)))
+
+    async def get_members(self, guild_id):
+        return list((await self._reference_data()).members.get(guild_id, {}))
+
+    async def has_member(self, guild_id, member_id):
+        return member_id in (await self._reference_data()).members.get(guild_id, {})
+
+    # Registered in any guild
+    async def has_user(self, member_id):
+        return any(member_id in members for members in (await self._reference_data()).members.values())
+
+    # Ids which are not in the guild's Members yet, in the given order
+    async def missing_members(self, guild_id, member_ids):
+        members = (await self._reference_data()).members.get(guild_id, {})
+        return [member_id for member_id in member_ids if member_id not in members]
+
+    async def update_birthday(self, guild_id, member_id, birthday):
+        await self.database.write("""
+            UPDATE Members 
+            SET birthday = ?
+            WHERE guild_id = ? AND id = ?
+        """, (birthday, guild_id, member_id))
+        self._update_reference(lambda reference: reference.update_member(guild_id, member_id, birthday=birthday))
+
+    # Rows are (name, member_id), names are updated in every guild
+    async def update_names_bulk(self, rows):
+        rows = list(rows)
+        await self.database.write_many("""
+            UPDATE Members
+            SET name = ?
+            WHERE id = ?;
+        """, rows)
+
+        def update(reference):
+            for name, member_id in rows:
+                reference.update_name(member_id, name)
+        self._update_reference(update)
+
+    # {member_id: name} of all guilds, name is None until it is known
+    async def get_member_names(self):
+        names = {}
+        for members in (await self._reference_data()).members.values():
+            for member_id, member in members.items():
+                if names.get(member_id) is None:
+                    names[member_id] = member.name
+        return names
+
+    async def get_member_name(self, member_id):
+        for members in (await self._reference_data()).members.values():
+            member = members.get(member_id)
+            if member is not None and member.name is not None:
+                return member.name
+
+    async def get_birthdays(self, guild_id):
+        members = (await self._reference_data()).members.get(guild_id, {})
+        return [(member_id, member.birthday, member.last_reported) for member_id, member in members.items()
+                if member.birthday is not None]
+
+    async def mark_congrated(self, guild_id, member_id, last_reported):
+        await self.database.write("""
+            UPDATE Members 
+            SET last_reported = ?
+            WHERE guild_id = ? AND id = ?
+        """, (last_reported, guild_id, member_id))
+        self._update_reference(lambda reference: reference.update_member(guild_id, member_id, last_reported=last_reported))
+
+    # Congratulation texts
     async def get_congrats(self):
-        async with self.database as db:
-            cur = await db.execute("""
-                SELECT text
-                FROM Congrats
-            """)
-            result = await cur.fetchall()
-        return result
+        return list((await self._reference_data()).congrats)
 
+    # Id of the video, added unless a concurrent write added the link first
     async def add_video(self, link, video_title):
-        async with self.database as db:
-            cur = await db.execute("""
+        rows = await self.database.write_transaction([
+            ("""
                 INSERT INTO Videos(link, video_title)
-                VALUES (?, ?);
-            """, (link, video_title))
-            await db.commit()
-            last_row = cur.lastrowid
-        return last_row
-
-    # Temp, for old videos
-    async def update_video_title(self, video_id, video_title=''):
-        async with self.database as db:
-            await db.execute("""
-                UPDATE Videos
-                SET video_title = ?
-                WHERE id = ?;
-            """, (video_title, video_id))
-            await db.commit()
-
-    async def enrich_video(self, video_id, artist, title):
-        async with self.database as db:
-            await db.execute("""
-                UPDATE Videos
-                SET artist = ?, title = ?
-                WHERE id = ?;
-            """, (artist, title, video_id))
-            await db.commit()
+                VALUES (?, ?)
+                ON CONFLICT(link) DO NOTHING;
+            """, (link, video_title), False),
+            ("""
+                SELECT id
+                FROM Videos
+                WHERE link = ?;
+            """, (link,), False),
+        ])
+        return rows[0][0]
 
-    async def get_videos(self):
-        async with self.database as db:
-            cur = await db.execute("""
-                SELECT id, link, video_title, artist, title
-                FROM Videos;
-            """)
-            result = await cur.fetchall()
-        return result
+    # Stream rows of the query in id order, chunk_size rows at a time. The query takes (last_id, limit)
+    async def _iter_chunks(self, query, chunk_size):
+        last_id = 0
+        while True:
+            async with self.database.read() as db:
+                cur = await db.execute(query, (last_id, chunk_size))
+                rows = await cur.fetchall()
+            if not rows:
+                return
+            yield rows
+            last_id = rows[-1][0]
+
+    def iter_videos_without_title(self, chunk_size=200):
+        return self._iter_chunks("""
+            SELECT id, link
+            FROM Videos
+            WHERE id > ? AND (video_title IS NULL OR video_title = '')
+            ORDER BY id
+            LIMIT ?;
+        """, chunk_size)
+
+    def iter_videos_without_artist(self, chunk_size=200):
+        return self._iter_chunks("""
+            SELECT id, link, video_title
+            FROM Videos
+            WHERE id > ? AND (artist IS NULL OR artist = '') AND video_title IS NOT NULL AND video_title != ''
+            ORDER BY id
+            LIMIT ?;
+        """, chunk_size)
+
+    def iter_videos_without_tags(self, chunk_size=200):
+        return self._iter_chunks("""
+            SELECT V.id, V.artist
+            FROM Videos V
+            LEFT JOIN Tags T ON T.video_id = V.id
+            WHERE V.id > ? AND V.artist IS NOT NULL AND V.artist != '' AND T.video_id IS NULL
+            ORDER BY V.id
+            LIMIT ?;
+        """, chunk_size)
+
+    # Rows are (video_title, video_id)
+    async def update_video_titles_bulk(self, rows):
+        await self.database.write_many("""
+            UPDATE Videos
+            SET video_title = ?
+            WHERE id = ?;
+        """, rows)
+
+    # Rows are (artist, title, video_id)
+    async def enrich_videos_bulk(self, rows):
+        await self.database.write_many("""
+            UPDATE Videos
+            SET artist = ?, title = ?
+            WHERE id = ?;
+        """, rows)
 
     async def get_video_by_link(self, link):
-        async with self.database as db:
+        async with self.database.read() as db:
             cur = await db.execute("""
                 SELECT id
                 FROM Videos
@@ -158,7 +978,7 @@ class AsyncDB:
             return result[0][0]
 
     async def has_it_been_posted(self, url, archive_channel):
-        async with self.database as db:
+        async with self.database.read() as db:
             cur = await db.execute("""
                 SELECT P.date_posted
                 FROM Posted P
@@ -170,17 +990,65 @@ class AsyncDB:
             return result[0][0]
 
     async def archive_video(self, video_id, archive_channel, source_channel, user_id, date_posted):
-        async with self.database as db:
-            cur = await db.execute("""
+        return await self.database.write("""
+            INSERT INTO Posted(video_id, archive_channel, source_channel, user_id, date_posted)
+            VALUES (?, ?, ?, ?, ?);
+        """, (video_id, archive_channel, source_channel, user_id, date_posted))
+
+    # {link: (video_id, posted)} for the links known in Videos, posted tells if the link is in the archive channel
+    async def get_archive_status(self, links, archive_channel):
+        result = {}
+        async with self.database.read() as db:
+            for start in range(0, len(links), MAX_VARIABLES):
+                chunk = links[start:start + MAX_VARIABLES]
+                cur = await db.execute(f"""
+                    SELECT V.link, V.id, EXISTS(
+                        SELECT 1
+                        FROM Posted P
+                        WHERE P.video_id = V.id AND P.archive_channel = ?
+                    )
+                    FROM Videos V
+                    WHERE V.link IN ({','.join('?' * len(chunk))});
+                """, [archive_channel] + chunk)
+                for link, video_id, posted in await cur.fetchall():
+                    result[link] = (video_id, bool(posted))
+        return result
+
+    # Rows are (link, video_title, source_channel, user_id, date_posted). Adds the missing videos and
+    # the archive records in one transaction
+    async def archive_videos_bulk(self, rows, archive_channel):
+        await self.database.write_transaction([
+            ("""
+                INSERT OR IGNORE INTO Videos(link, video_title)
+                VALUES (?, ?);
+            """, [(link, video_title) for link, video_title, source_channel, user_id, date_posted in rows], True),
+            ("""
                 INSERT INTO Posted(video_id, archive_channel, source_channel, user_id, date_posted)
-                VALUES (?, ?, ?, ?, ?);
-            """, (video_id, archive_channel, source_channel, user_id, date_posted))
-            await db.commit()
-            last_row = cur.lastrowid
-        return last_row
+                SELECT id, ?, ?, ?, ?
+                FROM Videos
+                WHERE link = ?;
+            """, [(archive_channel, source_channel, user_id, date_posted, link)
+                   for link, video_title, source_channel, user_id, date_posted in rows], True),
+        ])
+
+    # Remove the archive records of the links in the archive channel, in one transaction
+    async def unarchive_links(self, links, archive_channel):
+        statements = []
+        for start in range(0, len(links), MAX_VARIABLES):
+            chunk = links[start:start + MAX_VARIABLES]
+            statements.append((f"""
+                DELETE FROM Posted
+                WHERE archive_channel = ? AND video_id IN (
+                    SELECT id
+                    FROM Videos
+                    WHERE link IN ({','.join('?' * len(chunk))})
+                );
+            """, [archive_channel] + chunk, False))
+        if statements:
+            await self.database.write_transaction(statements)
 
     async def get_archived_video_by_id(self, posted_id):
-        async with self.database as db:
+        async with self.database.read() as db:
             cur = await db.execute("""
                 SELECT V.link, P.user_id, P.date_posted
                 FROM Posted P
@@ -191,139 +1059,186 @@ class AsyncDB:
         if result:
             return result[0]
 
-    async def add_tag(self, video_id, tag):
-        async with self.database as db:
-            await db.execute("""
-                INSERT INTO Tags(video_id, tag)
-                VALUES (?, ?);             
-            """, (video_id, tag))
-            await db.commit()
-
-    async def check_video_tags(self, video_id):
-        async with self.database as db:
-            cur = await db.execute("""
-                SELECT tag
-                FROM Tags
-                WHERE video_id = ?;
-            """, (video_id, ))
-            result = await cur.fetchall()
-        return result
+    # Rows are (video_id, tag)
+    async def add_tags_bulk(self, rows):
+        await self.database.write_many("""
+            INSERT INTO Tags(video_id, tag)
+            VALUES (?, ?);
+        """, rows)
 
     async def check_archive_stats_firstdate(self, archive_channel_id):
-        async with self.database as db:
+        span = await self.get_channel_span('archive', archive_channel_id)
+        if span:
+            return span[0]
+
+    async def get_archive_stats(self, archive_channel_id, date_from, date_to):
+        return await self._get_rollup_stats('archive', archive_channel_id, date_from, date_to)
+
+    # First and last date with stats of the kind ('messages' or 'archive') for the channel
+    async def get_channel_span(self, kind, channel_id):
+        async with self.database.read() as db:
             cur = await db.execute("""
-                SELECT date(MIN(date_posted))
-                FROM Posted
-                WHERE archive_channel = ?;
-            """, (archive_channel_id,))
+                SELECT first_date, last_date
+                FROM ChannelSpans
+                WHERE kind = ? AND channel_id = ?;
+            """, (kind, channel_id))
             result = await cur.fetchall()
         if result:
-            return result[0][0]
+            return result[0]
 
-    async def get_archive_stats(self, archive_channel_id, date_from, date_to):
-        async with self.database as db:
-            cur = await db.execute("""
-                SELECT user_id, count(id)
-                FROM Posted
-                WHERE archive_channel = ? AND date(date_posted) BETWEEN date(?) AND date(?)
-                GROUP by user_id;
-            """, (archive_channel_id, date_from, date_to))
+    # Per user counts for [date_from, date_to]: whole months and weeks come from rollups, only the edges
+    # are summed from daily rows. A range covering the whole channel span reads all-time totals
+    async def _get_rollup_stats(self, kind, channel_id, date_from, date_to):
+        span = await self.get_channel_span(kind, channel_id)
+        if not span:
+            return []
+        first_date, last_date = (date.fromisoformat(value) for value in span)
+        if date_from <= first_date and date_to >= last_date:
+            periods = {'total': ['']}
+        else:
+            date_from = max(date_from, first_date)
+            date_to = min(date_to, last_date)
+            if date_from > date_to:
+                return []
+            periods = _split_range(date_from, date_to)
+
+        queries = []
+        params = []
+        for period, buckets in periods.items():
+            if not buckets:
+                continue
+            placeholders = ','.join('?' * len(buckets))
+            if period == 'day' and kind == 'messages':
+                queries.append(f"""
+                    SELECT user_id, post_count
+                    FROM Statistics
+                    WHERE channel_id = ? AND date IN ({placeholders})
+                """)
+                params += [channel_id] + buckets
+            else:
+                queries.append(f"""
+                    SELECT user_id, post_count
+                    FROM Rollups
+                    WHERE kind = ? AND channel_id = ? AND period = ? AND bucket IN ({placeholders})
+                """)
+                params += [kind, channel_id, period] + buckets
+
+        async with self.database.read() as db:
+            cur = await db.execute(f"""
+                SELECT user_id, sum(post_count)
+                FROM ({' UNION ALL '.join(queries)})
+                GROUP BY user_id
+                HAVING sum(post_count) > 0;
+            """, params)
             result = await cur.fetchall()
         return result
 
-    async def add_stat(self, channel_id, date, user_id, post_count):
-        async with self.database as db:
-            await db.execute("""
+    # Write a whole batch of daily stats rows (channel_id, date, user_id, post_count) in one transaction.
+    # new_members are (guild_id, member_id) to register. Existing counts are replaced, or increased with accumulate=True
+    async def add_stats_bulk(self, stats_rows, new_members=(), accumulate=False):
+        if accumulate:
+            on_conflict = 'post_count = post_count + excluded.post_count'
+        else:
+            on_conflict = 'post_count = excluded.post_count'
+        new_members = list(new_members)
+        await self.database.write_transaction([
+            ("""
+                INSERT OR IGNORE INTO Members (guild_id, id, birthday)
+                VALUES (?, ?, NULL);
+            """, new_members, True),
+            (f"""
                 INSERT INTO Statistics(channel_id, date, user_id, post_count)
-                VALUES (?, ?, ?, ?);             
-            """, (channel_id, date, user_id, post_count))
-            await db.commit()
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(channel_id, date, user_id) DO UPDATE SET {on_conflict};
+            """, list(stats_rows), True),
+        ])
+        if new_members:
+            def update(reference):
+                for guild_id, member_id in new_members:
+                    reference.guild_members(guild_id).setdefault(member_id, MemberRecord(None, None, None))
+            self._update_reference(update)
 
     async def wipe_stats(self, channel_id):
-        async with self.database as db:
-            await db.execute("""
+        await self.database.write_transaction([
+            ("""
                 DELETE FROM Statistics
-                WHERE channel_id = ?;             
-            """, (channel_id, ))
-            await db.commit()
-            await db.execute("VACUUM")
+                WHERE channel_id = ?;
+            """, (channel_id, ), False),
+            ("""
+                DELETE FROM Rollups
+                WHERE kind = 'messages' AND channel_id = ?;
+            """, (channel_id, ), False),
+            ("""
+                DELETE FROM ChannelSpans
+                WHERE kind = 'messages' AND channel_id = ?;
+            """, (channel_id, ), False),
+        ])
+        await self.database.write_exclusive("VACUUM")
 
     async def wipe_stats_current_day(self, channel_id, date):
-        async with self.database as db:
-            await db.execute("""
-                DELETE FROM Statistics
-                WHERE channel_id = ? and date = ?;             
-            """, (channel_id, date))
-            await db.commit()
-            await db.execute("VACUUM")
-
-    async def check_stat_pk(self, channel_id, date, user_id):
-        async with self.database as db:
-            cur = await db.execute("""
-                SELECT date, user_id
-                FROM Statistics
-                WHERE channel_id = ? AND date = ? AND user_id = ?;
-            """, (channel_id, date, user_id))
-            result = await cur.fetchall()
-        return result
-
-    async def check_stat_lastdate(self, channel_id):
-        async with self.database as db:
-            cur = await db.execute("""
-                SELECT MAX(date)
-                FROM Statistics
-                WHERE channel_id = ?;
-            """, (channel_id, ))
-            result = await cur.fetchall()
-        if result:
-            return result[0][0]
+        await self.database.write("""
+            DELETE FROM Statistics
+            WHERE channel_id = ? and date = ?;             
+        """, (channel_id, date))
 
     async def check_stat_firstdate(self, channel_id):
-        async with self.database as db:
-            cur = await db.execute("""
-                SELECT MIN(date)
-                FROM Statistics
-                WHERE channel_id = ?;
-            """, (channel_id, ))
-            result = await cur.fetchall()
-        if result:
-            return result[0][0]
+        span = await self.get_channel_span('messages', channel_id)
+        if span:
+            return span[0]
 
     async def get_stats(self, channel_id,  date_from, date_to):
-        async with self.database as db:
-            cur = await db.execute("""
-                SELECT user_id, sum(post_count)
-                FROM Statistics
-                WHERE channel_id = ? AND date between date(?) AND date(?)
-                GROUP by user_id;
-            """, (channel_id, date_from, date_to))
-            result = await cur.fetchall()
-        return result
+        return await self._get_rollup_stats('messages', channel_id, date_from, date_to)
 
-    async def add_flag(self, flag_name, channel_id, flag_value=''):
-        async with self.database as db:
-            await db.execute("""
-                INSERT INTO Flags(flag_name, channel_id, flag_value)
-                VALUES (?, ?, ?);             
-            """, (flag_name, channel_id, flag_value))
-            await db.commit()
-
-    async def update_flag(self, flag_name, channel_id, flag_value):
-        async with self.database as db:
-            await db.execute("""
-                UPDATE Flags
-                SET flag_value = ?
-                WHERE flag_name = ? AND channel_id = ?;
-            """, (flag_value, flag_name, channel_id))
-            await db.commit()
+    # Insert or update in one statement, relies on the Flags_name_channel unique index
+    async def set_flag(self, flag_name, channel_id, flag_value=''):
+        await self.database.write("""
+            INSERT INTO Flags(flag_name, channel_id, flag_value)
+            VALUES (?, ?, ?)
+            ON CONFLICT(flag_name, channel_id) DO UPDATE SET flag_value = excluded.flag_value;
+        """, (flag_name, channel_id, flag_value))
+        # Stored as TEXT, keep what a read would return
+        stored = None if flag_value is None else str(flag_value)
+        self._update_reference(lambda reference: reference.flags.__setitem__((flag_name, channel_id), stored))
 
     async def get_flag(self, flag_name, channel_id):
-        async with self.database as db:
+        return (await self._reference_data()).flags.get((flag_name, channel_id))
+
+    async def get_lastfm_artist(self, artist):
+        async with self.database.read() as db:
             cur = await db.execute("""
-                SELECT flag_value
-                FROM Flags
-                WHERE flag_name = ? AND channel_id = ?;
-            """, (flag_name, channel_id))
+                SELECT tags, found, fetched_at
+                FROM LastfmArtists
+                WHERE artist = ?;
+            """, (artist,))
             result = await cur.fetchall()
         if result:
-            return result[0][0]
\ No newline at end of file
+            return result[0]
+
+    async def set_lastfm_artist(self, artist, tags, found, fetched_at):
+        await self.database.write("""
+            INSERT INTO LastfmArtists(artist, tags, found, fetched_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(artist) DO UPDATE SET tags = excluded.tags, found = excluded.found, fetched_at = excluded.fetched_at;
+        """, (artist, tags, found, fetched_at))
+
+    async def get_youtube_meta(self, video_ids):
+        result = []
+        async with self.database.read() as db:
+            for start in range(0, len(video_ids), MAX_VARIABLES):
+                chunk = video_ids[start:start + MAX_VARIABLES]
+                cur = await db.execute(f"""
+                    SELECT video_id, title, category, unavailable, fetched_at
+                    FROM YoutubeVideos
+                    WHERE video_id IN ({','.join('?' * len(chunk))});
+                """, chunk)
+                result += await cur.fetchall()
+        return result
+
+    # Rows are (video_id, title, category, unavailable, fetched_at)
+    async def set_youtube_meta(self, rows):
+        await self.database.write_many("""
+            INSERT INTO YoutubeVideos(video_id, title, category, unavailable, fetched_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(video_id) DO UPDATE SET title = excluded.title, category = excluded.category,
+                unavailable = excluded.unavailable, fetched_at = excluded.fetched_at;
+        """, rows)
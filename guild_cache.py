@@ -0,0 +1,52 @@
+# Member and emoji lookups without scanning discord.py collections. Built from client.guilds on_ready
+# and kept current from the gateway events
+class GuildCache:
+    def __init__(self):
+        # guild id -> {member id -> (display name, mention)}
+        self.guild_members = {}
+        # guild id -> {emoji name -> emoji}
+        self.guild_emojis = {}
+
+    def load(self, guilds):
+        self.guild_members.clear()
+        self.guild_emojis.clear()
+        for guild in guilds:
+            self.add_guild(guild)
+
+    def add_guild(self, guild):
+        self.guild_members[guild.id] = {member.id: (member.display_name, member.mention) for member in guild.members}
+        self.update_emojis(guild, guild.emojis)
+
+    def remove_guild(self, guild):
+        self.guild_members.pop(guild.id, None)
+        self.guild_emojis.pop(guild.id, None)
+
+    def add_member(self, member):
+        self.guild_members.setdefault(member.guild.id, {})[member.id] = (member.display_name, member.mention)
+
+    def remove_member(self, member):
+        self.guild_members.get(member.guild.id, {}).pop(member.id, None)
+
+    def update_emojis(self, guild, emojis):
+        self.guild_emojis[guild.id] = {emoji.name: emoji for emoji in emojis}
+
+    # {member id: (display name, mention)} of the guild, empty for unknown guilds and DMs
+    def members(self, guild_id):
+        return self.guild_members.get(guild_id, {})
+
+    def display_name(self, guild_id, member_id, default=None):
+        member = self.members(guild_id).get(member_id)
+        return member[0] if member else default
+
+    def mention(self, guild_id, member_id, default=None):
+        member = self.members(guild_id).get(member_id)
+        return member[1] if member else default
+
+    # The guild's own emoji first, the bot can use emojis of the other guilds as well
+    def emoji(self, name, guild_id=None):
+        emoji = self.guild_emojis.get(guild_id, {}).get(name)
+        if emoji is not None:
+            return emoji
+        for emojis in self.guild_emojis.values():
+            if name in emojis:
+                return emojis[name]
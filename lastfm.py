@@ -3,73 +3,159 @@
 Wrappers for Telegram, Last.fm(in future) and Discogs(in future) APIs - taken from MusicBro. Lastfm only here!
 
 """
+import asyncio
+import json
 import logging
-import os
-import sys
+import random
 import time
-import urllib3
 
-import requests
+import aiohttp
+
+from caching import LRUCache
+from metrics import instrumented, timed
+
+
+# Async token bucket, no more than `rate` requests per second on average (bursts up to `capacity`)
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+# Artist lookup cache: in-process LRU in front of a SQLite table. Found artists and
+# 'not found' answers are kept for separate periods
+class ArtistCache:
+    def __init__(self, db, ttl=30*24*3600, negative_ttl=7*24*3600, maxsize=4096):
+        self.db = db
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.memory = LRUCache(maxsize)
+        self.db_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(artist):
+        return artist.strip().lower()
+
+    # Return cached tags, False for a cached 'not found' or None if there is nothing fresh
+    async def get(self, artist):
+        key = self._key(artist)
+        tags = self.memory.get(key)
+        if tags is not None:
+            return tags
+
+        row = await self.db.get_lastfm_artist(key)
+        if row:
+            tags, found, fetched_at = row
+            age = time.time() - fetched_at
+            if found and age < self.ttl:
+                tags = json.loads(tags)
+                self.memory.set(key, tags, self.ttl - age)
+                self.db_hits += 1
+                return tags
+            if not found and age < self.negative_ttl:
+                self.memory.set(key, False, self.negative_ttl - age)
+                self.db_hits += 1
+                return False
+        self.misses += 1
+
+    async def set(self, artist, tags):
+        key = self._key(artist)
+        if tags:
+            self.memory.set(key, tags, self.ttl)
+            await self.db.set_lastfm_artist(key, json.dumps(tags), True, int(time.time()))
+        else:
+            self.memory.set(key, False, self.negative_ttl)
+            await self.db.set_lastfm_artist(key, None, False, int(time.time()))
+
+    def stats(self):
+        return {'memory_hits': self.memory.hits, 'db_hits': self.db_hits, 'misses': self.misses}
 
 
 # Wrapper parent class
 class Requester:
-    def __init__(self, token, proxies={}, rate_limit=1, error_retries=3):
-        # Setup logging
-        # session_hash = os.environ['MB_SESSION_HASH']
-        # module = os.environ['MB_MODULE']
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self, token, proxy=None, rate_limit=1, error_retries=3, max_connections=10, timeout=10, backoff=1, cache=None):
         self.logger = logging.getLogger("comrade")
 
         self.token = token
         self.headers = {'User-Agent': 'MusicBro/alpha'}
-        self.proxies = proxies
+        self.proxy = proxy
 
         self.error_retries = error_retries
         self.rate_limit = rate_limit
-
-        self.request_time = 0
-
-    # Get url via requests. Return response with status 200 or raise an error
-    def _get_url(self, url, params={}):
-        for _ in range(self.error_retries):
-            self._request_throttle()
-            self.request_time = time.time()
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.backoff = backoff
+
+        self.bucket = TokenBucket(rate_limit)
+        self.cache = cache
+        self.session = None
+
+    # One pooled session for all requests, created lazily inside the running loop
+    def _get_session(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections)
+            timeout = aiohttp.ClientTimeout(total=self.timeout)
+            self.session = aiohttp.ClientSession(headers=self.headers, connector=connector, timeout=timeout)
+        return self.session
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+    # Get url and return decoded json. Retry with exponential backoff on 429/5xx and connection errors
+    @timed('lastfm', 'request')
+    async def _get_url(self, url, params={}):
+        session = self._get_session()
+        for attempt in range(self.error_retries):
+            await self.bucket.acquire()
+            retry_after = 0
             try:
-                response = requests.get(url, headers=self.headers, proxies=self.proxies, params=params)
-                self.last_response = response
-                if response.status_code == 200:
-                    self.logger.debug('{}: {}'.format(response.status_code, url))
-                    return response.json()
-                else:
-                    self.logger.warning('{}: {}'.format(response.status_code, url))
-            except:
-                self.logger.error('{} on {}'.format(sys.exc_info(), url))
-        else:
-            self.logger.error('Too many request errors in a row')
-            raise UserWarning('Too many request errors in a row')
-
-    # Rate limiter, no more than n requests per second
-    def _request_throttle(self):
-        n = self.rate_limit
-        since_last_request = time.time() - self.request_time
-        if since_last_request < 1/n:
-            time.sleep(1/n - since_last_request)
-
-
-# Telegram wrapper subclass
+                async with session.get(url, params=params, proxy=self.proxy) as response:
+                    self.last_response = response
+                    if response.status == 200:
+                        self.logger.debug('{}: {}'.format(response.status, response.url))
+                        return await response.json(content_type=None)
+                    self.logger.warning('{}: {}'.format(response.status, response.url))
+                    if response.status not in self.retry_statuses:
+                        # Not worth retrying, let the caller check the error payload
+                        return await response.json(content_type=None)
+                    retry_after = float(response.headers.get('Retry-After', 0) or 0)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                self.logger.error('{} on {}'.format(repr(e), url))
+            delay = max(retry_after, self.backoff * 2 ** attempt)
+            await asyncio.sleep(delay + random.uniform(0, self.backoff))
+
+        self.logger.error('Too many request errors in a row')
+        raise UserWarning('Too many request errors in a row')
+
+
+# Last.fm wrapper subclass
+@instrumented('lastfm')
 class LastRequester(Requester):
     api_endpoint = 'https://ws.audioscrobbler.com/2.0/'
 
-
-    # Construct url string from parameters
-    def _make_url(self, method, params={}):
-
-        url = f'{self.api_endpoint}?method={method}&api_key={self.token}&format=json'
-        if params:
-            params = [key + '=' + params[key] for key in params]
-            params = '&' + '&'.join(params)
-            url += params
-        return url
+    # Construct query parameters (aiohttp does the encoding)
+    def _make_params(self, method, params={}):
+        query = {'method': method, 'api_key': self.token, 'format': 'json'}
+        query.update(params)
+        return query
 
     # Check and report response status
     def _check_response_status(self, response):
@@ -78,14 +164,27 @@ class LastRequester(Requester):
         else:
             return False
 
-    # Check if artist exists
-    def check_artist(self, artist):
+    # Check if artist exists. Return up to 5 top tags or False
+    async def check_artist(self, artist):
+        if self.cache is not None:
+            tags = await self.cache.get(artist)
+            if tags is not None:
+                return tags
+        tags = await self._get_artist_tags(artist)
+        if self.cache is not None:
+            await self.cache.set(artist, tags)
+        return tags
+
+    async def _get_artist_tags(self, artist):
         params = {}
         params['artist'] = artist
         params['autocorrect'] = '1'
-        url = self._make_url('artist.getTopTags', params)
 
-        response = self._get_url(url)
+        response = await self._get_url(self.api_endpoint, self._make_params('artist.getTopTags', params))
+        # Error 6 is 'artist not found', anything else (bad key, rate limit) must not end up in the cache
+        if isinstance(response, dict) and response.get('error') not in (None, 6):
+            self.logger.error(f"Last.fm error {response.get('error')}: {response.get('message')}")
+            raise UserWarning(f"Last.fm error {response.get('error')}")
         try:
             tags = [tag['name'] for tag in response['toptags']['tag']]
             if 'seen live' in tags:
@@ -93,4 +192,3 @@ class LastRequester(Requester):
             return tags[0:5]
         except:
             return False
-
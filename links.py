@@ -0,0 +1,92 @@
+from collections import namedtuple
+from urllib.parse import parse_qs
+import re
+
+
+# provider is None for links no provider claims, video_id is '' then
+Link = namedtuple('Link', ['provider', 'url', 'video_id'])
+
+Provider = namedtuple('Provider', ['name', 'extract_id', 'canonical_url'])
+
+# Host (without www./m.) -> provider
+PROVIDERS = {}
+
+# Scheme is optional, at least location + path should be present, eg. 'youtube.com/a'.
+# Groups: host, path, query
+URL_PATTERN = re.compile(
+    r'(?:(?:https?|ftp)://)?((?:[\w-]+\.)+[a-zA-Z]{2,})((?:/[\w\-=%$&!+~.]+)+/?)(?:\?([\w\-=%$&!+~./]*))?'
+)
+
+
+# Register a provider for the hosts. extract_id(path, query) returns video id or None if the link
+# is not a video, canonical_url(video_id) builds the url stored in the archive
+def register_provider(name, hosts, extract_id, canonical_url):
+    provider = Provider(name, extract_id, canonical_url)
+    for host in hosts:
+        PROVIDERS[host] = provider
+    return provider
+
+
+def _find_provider(host):
+    host = host.lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    elif host.startswith('m.'):
+        host = host[2:]
+    provider = PROVIDERS.get(host)
+    # Subdomains (eg. artist.bandcamp.com) fall back to the parent domain
+    while provider is None and host.count('.') > 1:
+        host = host.split('.', 1)[1]
+        provider = PROVIDERS.get(host)
+    return provider
+
+
+# All links in the text in one pass: [Link(provider, canonical url, video id), ...]
+def classify_links(content):
+    links = []
+    for match in URL_PATTERN.finditer(content):
+        host, path, query = match.groups()
+        # Sentence punctuation right after a link is not a part of it
+        if query is None:
+            path = path.rstrip('.!')
+        else:
+            query = query.rstrip('.!')
+        provider = _find_provider(host)
+        video_id = provider.extract_id(path, query or '') if provider else None
+        if video_id:
+            links.append(Link(provider.name, provider.canonical_url(video_id), video_id))
+        else:
+            links.append(Link(None, match.group(0).rstrip('.!'), ''))
+    return links
+
+
+# First link from a provider, or None
+def find_video_link(content):
+    for link in classify_links(content):
+        if link.provider:
+            return link
+
+
+def _youtube_watch_id(path, query):
+    if path.rstrip('/') == '/watch':
+        video_ids = parse_qs(query).get('v')
+        if video_ids:
+            return video_ids[0]
+
+
+def _first_path_segment(path, query):
+    return path.strip('/').split('/')[0]
+
+
+def _last_numeric_segment(path, query):
+    for segment in reversed(path.strip('/').split('/')):
+        if segment.isdigit():
+            return segment
+
+
+register_provider('youtube', ('youtube.com',), _youtube_watch_id,
+                  lambda video_id: 'https://www.youtube.com/watch?v=' + video_id)
+register_provider('youtube', ('youtu.be',), _first_path_segment,
+                  lambda video_id: 'https://www.youtube.com/watch?v=' + video_id)
+register_provider('vimeo', ('vimeo.com',), _last_numeric_segment,
+                  lambda video_id: 'https://vimeo.com/' + video_id)
@@ -0,0 +1,74 @@
+from collections import Counter
+from datetime import datetime
+import asyncio
+import logging
+
+
+# In-memory message counters per (channel_id, date, user_id), fed from on_message and flushed
+# to the Statistics table with additive upserts. Only messages created after start() are counted,
+# everything before that is covered by history scans. A rescan of a channel takes over its messages
+# created before the rescan started
+class LiveStats:
+    def __init__(self, db):
+        self.logger = logging.getLogger("comrade")
+        self.db = db
+        self.since = None
+        self.pending = Counter()
+        # channel id -> guild id, new posters are registered as members of the guild
+        self.channel_guilds = {}
+        # channel id -> (until, covers) of the last rescan, covers(day) tells if the scan rewrites the day
+        self.rescans = {}
+        self.lock = asyncio.Lock()
+
+    def start(self):
+        if self.since is None:
+            self.since = datetime.utcnow()
+        return self.since
+
+    # created_at is naive UTC (as discord.py gives it), day is the local date the message belongs to
+    def add(self, guild_id, channel_id, day, user_id, created_at):
+        if self.since is None or created_at < self.since:
+            return
+        rescan = self.rescans.get(channel_id)
+        if rescan is not None and created_at < rescan[0] and rescan[1](day):
+            return
+        self.channel_guilds[channel_id] = guild_id
+        self.pending[(channel_id, day, user_id)] += 1
+
+    # Unflushed counts for the channel within [date_from, date_to], {user_id: count}
+    def get_pending(self, channel_id, date_from, date_to):
+        result = Counter()
+        for (pending_channel, day, user_id), count in self.pending.items():
+            if pending_channel == channel_id and date_from <= day <= date_to:
+                result[user_id] += count
+        return result
+
+    # Hand the channel over to a history scan. prepare(until) returns (covers, wipe): the day filter and
+    # the coroutine clearing the stored rows of those days. Pending counts of the covered days are dropped
+    # and the rows wiped under the flush lock, so flushes only ever add messages created after until.
+    # Returns until, the scan boundary
+    async def rescan(self, channel_id, prepare):
+        async with self.lock:
+            until = datetime.utcnow()
+            covers, wipe = prepare(until)
+            self.rescans[channel_id] = (until, covers)
+            for key in [key for key in self.pending if key[0] == channel_id and covers(key[1])]:
+                del self.pending[key]
+            await wipe
+        return until
+
+    async def flush(self):
+        async with self.lock:
+            if not self.pending:
+                return 0
+            pending, self.pending = self.pending, Counter()
+            rows = [(channel_id, day.strftime('%Y-%m-%d'), user_id, count) for (channel_id, day, user_id), count in pending.items()]
+            try:
+                new_members = {(self.channel_guilds[channel_id], user_id) for channel_id, day, user_id in pending}
+                await self.db.add_stats_bulk(rows, new_members, accumulate=True)
+            except:
+                # Keep the counts for the next attempt
+                self.pending.update(pending)
+                raise
+            self.logger.debug(f'Flushed {len(rows)} live stat counters')
+            return len(rows)
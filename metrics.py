@@ -0,0 +1,182 @@
+from functools import wraps
+import inspect
+import logging
+import threading
+import time
+
+from aiohttp import web
+
+
+# Latency buckets, seconds. Prometheus style: cumulative, the last one is +Inf
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+
+# Latency histogram of a single operation plus call and error counters
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds, error=False):
+        for index, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[index] += 1
+                break
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        if error:
+            self.errors += 1
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    # Upper bound of the bucket holding the quantile, capped with the observed max
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+# Histograms by (kind, name), eg. ('db', 'get_stats'). Observed from the loop and from
+# executor threads (youtube), hence the lock
+class Metrics:
+    def __init__(self):
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def observe(self, kind, name, seconds, error=False):
+        with self.lock:
+            histogram = self.histograms.get((kind, name))
+            if histogram is None:
+                histogram = self.histograms[(kind, name)] = Histogram()
+            histogram.observe(seconds, error)
+
+    def clear(self):
+        with self.lock:
+            self.histograms.clear()
+
+    # [(kind, name, histogram), ...] slowest first by p95, then by mean
+    def top(self, limit=10):
+        with self.lock:
+            items = [(kind, name, histogram) for (kind, name), histogram in self.histograms.items()]
+        items.sort(key=lambda item: (item[2].quantile(0.95), item[2].mean), reverse=True)
+        return items[:limit]
+
+    # Prometheus text exposition format
+    def render(self):
+        with self.lock:
+            items = sorted(self.histograms.items())
+            lines = [
+                '# HELP comrade_operation_seconds Latency of bot operations.',
+                '# TYPE comrade_operation_seconds histogram',
+            ]
+            for (kind, name), histogram in items:
+                labels = f'kind="{kind}",name="{name}"'
+                cumulative = 0
+                for bound, count in zip(BUCKETS, histogram.buckets):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'comrade_operation_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+                lines.append(f'comrade_operation_seconds_sum{{{labels}}} {histogram.total}')
+                lines.append(f'comrade_operation_seconds_count{{{labels}}} {histogram.count}')
+            lines.append('# HELP comrade_operation_errors_total Failed bot operations.')
+            lines.append('# TYPE comrade_operation_errors_total counter')
+            for (kind, name), histogram in items:
+                lines.append(f'comrade_operation_errors_total{{kind="{kind}",name="{name}"}} {histogram.errors}')
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+
+
+# Function decorator, records every call of the (async or plain) function under kind/name
+def timed(kind, name=None):
+    def decorator(func):
+        operation = name or func.__name__
+
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                error = False
+                try:
+                    return await func(*args, **kwargs)
+                except:
+                    error = True
+                    raise
+                finally:
+                    METRICS.observe(kind, operation, time.perf_counter() - started, error)
+        else:
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                error = False
+                try:
+                    return func(*args, **kwargs)
+                except:
+                    error = True
+                    raise
+                finally:
+                    METRICS.observe(kind, operation, time.perf_counter() - started, error)
+        return wrapper
+    return decorator
+
+
+# Class decorator, times all public methods including inherited ones. Async generators are
+# left alone, their consumers decide how long they take
+def instrumented(kind):
+    def decorator(cls):
+        for name, member in inspect.getmembers(cls, inspect.isfunction):
+            if name.startswith('_') or inspect.isasyncgenfunction(member):
+                continue
+            if isinstance(inspect.getattr_static(cls, name), (staticmethod, classmethod)):
+                continue
+            setattr(cls, name, timed(kind, name)(member))
+        return cls
+    return decorator
+
+
+# Local HTTP endpoint for Prometheus scraping, GET /metrics
+class MetricsServer:
+    def __init__(self, host='127.0.0.1', port=9108, metrics=METRICS):
+        self.logger = logging.getLogger("comrade")
+        self.host = host
+        self.port = port
+        self.metrics = metrics
+        self.runner = None
+
+    async def _handle(self, request):
+        return web.Response(text=self.metrics.render(), content_type='text/plain', charset='utf-8')
+
+    async def start(self):
+        if self.runner is not None:
+            return
+        app = web.Application()
+        app.router.add_get('/metrics', self._handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, self.host, self.port).start()
+        except OSError as e:
+            await runner.cleanup()
+            self.logger.error(f'Cant start metrics endpoint on {self.host}:{self.port}: {repr(e)}')
+            return
+        self.runner = runner
+        self.logger.info(f'Metrics endpoint listening on http://{self.host}:{self.port}/metrics')
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
@@ -0,0 +1,53 @@
+import asyncio
+import logging
+
+
+# Producer/consumer pipeline. Chunks from the async `source` are handled by `concurrency` workers running
+# `process(chunk) -> rows`, a single consumer writes each non-empty result with `write(rows)`.
+# Queues are bounded, so the source is never read far ahead of the writer. Returns the number of rows written
+async def run_pipeline(source, process, write, concurrency=4):
+    logger = logging.getLogger("comrade")
+    chunks = asyncio.Queue(maxsize=concurrency * 2)
+    results = asyncio.Queue(maxsize=concurrency * 2)
+
+    async def produce():
+        async for chunk in source:
+            await chunks.put(chunk)
+        for _ in range(concurrency):
+            await chunks.put(None)
+
+    async def work():
+        while True:
+            chunk = await chunks.get()
+            if chunk is None:
+                break
+            try:
+                rows = await process(chunk)
+            except Exception as e:
+                logger.error(f'Pipeline failed to process a chunk of {len(chunk)}: {repr(e)}')
+                rows = []
+            await results.put(rows)
+        await results.put(None)
+
+    async def consume():
+        written = 0
+        finished = 0
+        while finished < concurrency:
+            rows = await results.get()
+            if rows is None:
+                finished += 1
+            elif rows:
+                await write(rows)
+                written += len(rows)
+        return written
+
+    tasks = [asyncio.ensure_future(produce())]
+    tasks += [asyncio.ensure_future(work()) for _ in range(concurrency)]
+    consumer = asyncio.ensure_future(consume())
+    try:
+        await asyncio.gather(consumer, *tasks)
+    except:
+        for task in tasks + [consumer]:
+            task.cancel()
+        raise
+    return consumer.result()
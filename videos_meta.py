@@ -1,20 +1,34 @@
 import re
 
-# Try to parse
-def parse_title(video_title):
-    delimiters = ('-', '–', '—', '|', '/')
-    for delimiter in delimiters:
-        parts = video_title.split(delimiter, maxsplit=1)
-        if len(parts) > 1:
-            return parts
+# In priority order: the first delimiter found in the title wins, not the leftmost one
+DELIMITERS = ('-', '–', '—', '|', '/')
 
-# Remove unwanted unicode
-def remove_unicode(title):
-    for character in title:
-        if character > '\u4e20':
-            title = title.replace(character, '')
-    return title
+BRACKETS_PATTERN = re.compile(r'[\(\[].*?[\)\]]')
 
-# Remove brackets
-def remove_brackets(title):
-    return re.sub('[\(\[].*?[\)\]]', '', title)
\ No newline at end of file
+
+# Everything above U+4E20. A character class scan beats str.translate with a mapping,
+# which does a dict lookup per character
+UNICODE_PATTERN = re.compile('[\u4e21-\U0010ffff]+')
+
+
+# Split titles into cleaned (artist, title) pairs, yields None for titles that can't be parsed.
+# The filtered characters are never delimiters, so the whole title is filtered once before the split
+def normalize_titles(titles):
+    strip_unicode = UNICODE_PATTERN.sub
+    strip_brackets = BRACKETS_PATTERN.sub
+    for video_title in titles:
+        if not video_title.isascii():
+            video_title = strip_unicode('', video_title)
+        for delimiter in DELIMITERS:
+            position = video_title.find(delimiter)
+            if position >= 0:
+                break
+        else:
+            yield None
+            continue
+        artist = video_title[:position]
+        title = video_title[position + len(delimiter):]
+        if '(' in video_title or '[' in video_title:
+            artist = strip_brackets('', artist)
+            title = strip_brackets('', title)
+        yield artist.strip(), title.strip()
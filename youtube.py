@@ -1,4 +1,9 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 import logging
+import sys
+import threading
+import time
 
 import httplib2
 from oauth2client.file import Storage
@@ -6,8 +11,15 @@ from googleapiclient.discovery import build
 from oauth2client.client import flow_from_clientsecrets
 from oauth2client.tools import run_flow
 
+from caching import LRUCache
+from metrics import instrumented
+
+@instrumented('youtube')
 class YoutubePlaylists():
-    def __init__(self, CLIENT_SECRETS_FILE, CREDENTIALS_FILE):
+    # videos.list accepts up to 50 ids per call
+    batch_size = 50
+
+    def __init__(self, CLIENT_SECRETS_FILE, CREDENTIALS_FILE, max_workers=4, timeout=10):
         logger = logging.getLogger("comrade")
         # Login or create credentials
         YOUTUBE_SCOPE = "https://www.googleapis.com/auth/youtube"
@@ -22,11 +34,35 @@ class YoutubePlaylists():
             credentials = run_flow(flow, storage)
             logger.info('Youtube credentials updated')
 
-        self.service = build(YOUTUBE_API_SERVICE_NAME, YOUTUBE_API_VERSION, http=credentials.authorize(httplib2.Http()))
+        self.credentials = credentials
+        self.timeout = timeout
+        self._local = threading.local()
+        self.service = build(YOUTUBE_API_SERVICE_NAME, YOUTUBE_API_VERSION, http=self._get_http())
+
+        # Blocking API calls run on a dedicated pool, capped to max_workers calls in flight
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='youtube')
+        self.semaphore = asyncio.Semaphore(max_workers)
+
+    # httplib2.Http is not thread-safe, so every thread gets its own authorized instance
+    def _get_http(self):
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = self.credentials.authorize(httplib2.Http(timeout=self.timeout))
+            self._local.http = http
+        return http
+
+    # Run blocking call on the pool without blocking the event loop
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        async with self.semaphore:
+            return await asyncio.wait_for(loop.run_in_executor(self.executor, func, *args), self.timeout)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
 
     def _request_youtube(self, request):
         try:
-            response = request.execute()
+            response = request.execute(http=self._get_http())
             if 'error' in response:
                 error_code = response['error']['errors']['code']
                 error_message = response['error']['errors']['message']
@@ -83,6 +119,95 @@ class YoutubePlaylists():
     #
     #     return videos
 
-    def get_video_info(self, video_id):
-        request = self.service.videos().list(part='snippet', id=video_id)
-        return self._request_youtube(request)
\ No newline at end of file
+    # Get snippets for any number of videos in chunks of 50 ids per call.
+    # Returns {video_id: snippet}, missing (deleted, private) videos are mapped to None
+    def get_videos_info(self, video_ids):
+        video_ids = list(dict.fromkeys(video_id for video_id in video_ids if video_id))
+        snippets = dict.fromkeys(video_ids)
+        for start in range(0, len(video_ids), self.batch_size):
+            chunk = video_ids[start:start + self.batch_size]
+            request = self.service.videos().list(part='snippet', id=','.join(chunk), maxResults=self.batch_size)
+            response = self._request_youtube(request)
+            for item in response.get('items', []):
+                snippets[item['id']] = item['snippet']
+        return snippets
+
+    # Awaitable version, each videos.list call runs on the pool with its own timeout
+    async def fetch_videos_info(self, video_ids):
+        video_ids = list(dict.fromkeys(video_id for video_id in video_ids if video_id))
+        chunks = [video_ids[start:start + self.batch_size] for start in range(0, len(video_ids), self.batch_size)]
+        snippets = {}
+        for chunk_snippets in await asyncio.gather(*(self._run(self.get_videos_info, chunk) for chunk in chunks)):
+            snippets.update(chunk_snippets)
+        return snippets
+
+
+# Video metadata cache keyed by youtube video id: bounded LRU in front of a DB table.
+# Deleted/private videos are cached too (as None), entries older than refresh_age are refetched
+class VideoMetaCache:
+    def __init__(self, youtube, db, maxsize=10000, refresh_age=7*24*3600):
+        self.logger = logging.getLogger("comrade")
+        self.youtube = youtube
+        self.db = db
+        self.refresh_age = refresh_age
+        self.memory = LRUCache(maxsize, ttl=refresh_age)
+        self.db_hits = 0
+        self.misses = 0
+
+    # Returns {video_id: {'title': ..., 'categoryId': ...} or None for unavailable videos}.
+    # Ids which could not be resolved at all (API errors, nothing cached) are left out
+    async def get_many(self, video_ids):
+        video_ids = list(dict.fromkeys(video_id for video_id in video_ids if video_id))
+        result = {}
+        missing = []
+        for video_id in video_ids:
+            if video_id in self.memory:
+                result[video_id] = self.memory.get(video_id)
+            else:
+                missing.append(video_id)
+        if not missing:
+            return result
+
+        # DB level
+        stale = {}
+        now = time.time()
+        for video_id, title, category, unavailable, fetched_at in await self.db.get_youtube_meta(missing):
+            snippet = None if unavailable else {'title': title, 'categoryId': category}
+            age = now - fetched_at
+            if age < self.refresh_age:
+                result[video_id] = snippet
+                self.memory.set(video_id, snippet, self.refresh_age - age)
+                self.db_hits += 1
+            else:
+                stale[video_id] = snippet
+        missing = [video_id for video_id in missing if video_id not in result]
+        if not missing:
+            return result
+
+        # Network level, fall back to stale data if youtube is unavailable
+        self.misses += len(missing)
+        try:
+            snippets = await self.youtube.fetch_videos_info(missing)
+        except Exception as e:
+            self.logger.error(f'Error retrieving video info for {len(missing)} videos: {repr(e)}')
+            result.update(stale)
+            return result
+
+        rows = []
+        for video_id in missing:
+            snippet = snippets.get(video_id)
+            if snippet is not None:
+                snippet = {'title': snippet.get('title'), 'categoryId': snippet.get('categoryId')}
+                rows.append((video_id, snippet['title'], snippet['categoryId'], False, int(now)))
+            else:
+                rows.append((video_id, None, None, True, int(now)))
+            result[video_id] = snippet
+            self.memory.set(video_id, snippet)
+        await self.db.set_youtube_meta(rows)
+        return result
+
+    async def get(self, video_id):
+        return (await self.get_many([video_id])).get(video_id)
+
+    def stats(self):
+        return {'memory_hits': self.memory.hits, 'db_hits': self.db_hits, 'misses': self.misses}